@@ -1,6 +1,3 @@
-import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
-import os
 from flask import Flask, request, current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
@@ -8,6 +5,7 @@ from flask_login import LoginManager
 from flask_mail import Mail
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
+from werkzeug.middleware.proxy_fix import ProxyFix
 from config import Config
 
 def get_locale():
@@ -16,7 +14,8 @@ def get_locale():
     # return 'es' to try spanish
     return request.accept_languages.best_match(current_app.config['LANGUAGES'])
 
-db = SQLAlchemy() # Initialising the SQLAlchemy extension with the Flask application
+from app.replicas import RoutingSession
+db = SQLAlchemy(session_options={'class_': RoutingSession}) # Initialising the SQLAlchemy extension with the Flask application, its session can route reads to replicas
 migrate = Migrate() # Initialising the Flask-Migrate extension with your Flask application and SQLAlchemy instance
 login = LoginManager() # Initialising the login manager right after the application instance
 login.login_view = 'auth.login' # 'login' is the function (or endpoint) name for the login view
@@ -29,8 +28,22 @@ babel = Babel() # Babel instance initialised a locale_selector, which is set to
 def create_app(config_class=Config):
     app = Flask(__name__) # Flask application instance
     app.config.from_object(config_class)
+    if app.config['REVERSE_PROXIES']:
+        # request.remote_addr and the scheme of external URLs come from the headers set by the proxies
+        app.wsgi_app = ProxyFix(app.wsgi_app,
+                                x_for=app.config['REVERSE_PROXIES'],
+                                x_proto=app.config['REVERSE_PROXIES'])
     
+    from app import sqlite, replicas
+    # Pool options and replica binds have to be in place before Flask-SQLAlchemy creates the engines
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = sqlite.engine_options(app.config)
+    app.config['SQLALCHEMY_BINDS'] = replicas.binds(app.config)
     db.init_app(app)
+    # Replicas hold copies of the primary's tables, not tables of their own, so create_all() and drop_all() leave them alone
+    for key in list(db.metadatas):
+        if replicas.is_replica(key):
+            del db.metadatas[key]
+    sqlite.init_app(app)
     migrate.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
@@ -45,37 +58,45 @@ def create_app(config_class=Config):
 
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
+
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api/v1')
     
     from app.cli import bp as cli_bp
     app.register_blueprint(cli_bp)
 
-    if not app.debug and not app.testing:
-        if app.config['MAIL_SERVER']:
-            auth = None
-            if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-                auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-            secure = None
-            if app.config['MAIL_USE_TLS']:
-                secure = ()
-            mail_handler = SMTPHandler(
-                mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-                fromaddr='no-reply@' + app.config['MAIL_SERVER'],
-                toaddrs=app.config['ADMINS'], subject='Microblog Failure',
-                credentials=auth, secure=secure)
-            mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
-        
-        if not os.path.exists('logs'):
-            os.mkdir('logs')
-        file_handler = RotatingFileHandler('logs/microblog.log', maxBytes=10240,
-                                        backupCount=10)
-        file_handler.setFormatter(logging.Formatter(
-            '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-        file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
-
-        app.logger.setLevel(logging.INFO)
-        app.logger.info('Microblog startup')
+    from app.ratelimit import limiter
+    limiter.init_app(app)
+
+    from app.passwords import hasher as password_hasher
+    password_hasher.init_app(app)
+
+    from app.user_cache import cache as user_cache
+    user_cache.init_app(app)
+
+    from app.last_seen import tracker
+    tracker.init_app(app)
+
+    from app.translate import cache as translation_cache
+    translation_cache.init_app(app)
+
+    from app.language import detector as language_detector
+    language_detector.init_app(app)
+
+    from app.email import mail_queue
+    mail_queue.init_app(app)
+
+    from app.stream import post_stream
+    post_stream.init_app(app)
+
+    from app.fragments import fragment_cache
+    fragment_cache.init_app(app)
+
+    from app.instrumentation import instrumentation
+    instrumentation.init_app(app)
+
+    from app.log import log_pipeline
+    log_pipeline.init_app(app)
     
     return app
 
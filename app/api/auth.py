@@ -0,0 +1,41 @@
+from functools import wraps
+import sqlalchemy as sa
+from flask import g, request
+from app import db
+from app.models import User
+from app.api.errors import error_response
+
+
+# API requests authenticate with an 'Authorization: Bearer <token>' header instead of the session cookie
+# The user is available as g.api_user in the view
+def token_auth_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '') \
+            .partition(' ')
+        user = User.check_token(token) \
+            if scheme.lower() == 'bearer' and token else None
+        if user is None:
+            response = error_response(401)
+            return response[0], 401, {'WWW-Authenticate': 'Bearer'}
+        g.api_user = user
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+# Username and password, only used to get a token
+def basic_auth_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        auth = request.authorization
+        user = None
+        if auth is not None and auth.type == 'basic':
+            user = db.session.scalar(
+                sa.select(User).where(User.username == auth.username))
+        if user is None or user.password_hash is None or \
+                not user.check_password(auth.password):
+            response = error_response(401)
+            return response[0], 401, {'WWW-Authenticate': 'Basic'}
+        g.api_user = user
+        return f(*args, **kwargs)
+    return decorated_function
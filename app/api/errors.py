@@ -0,0 +1,24 @@
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import HTTP_STATUS_CODES
+from app.api import bp
+
+
+# Errors of the API are JSON documents instead of HTML pages
+def error_response(status_code, message=None):
+    payload = {'error': HTTP_STATUS_CODES.get(status_code, 'Unknown error')}
+    if message:
+        payload['message'] = message
+    return payload, status_code
+
+
+def bad_request(message):
+    return error_response(400, message)
+
+
+# The headers of the error (Retry-After, WWW-Authenticate...) are kept, only its HTML body is replaced
+@bp.errorhandler(HTTPException)
+def handle_exception(e):
+    headers = [(name, value) for name, value in e.get_response().headers
+               if name not in ('Content-Type', 'Content-Length')]
+    payload, status_code = error_response(e.code)
+    return payload, status_code, headers
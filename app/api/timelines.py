@@ -0,0 +1,99 @@
+import json
+from datetime import timezone
+import sqlalchemy as sa
+from flask import current_app, g, request
+from app import db
+from app.api import bp
+from app.api.auth import token_auth_required
+from app.api.errors import bad_request
+from app.models import User, Post, avatar_url
+from app.pagination import keyset_paginate
+from app.replicas import read_replica
+
+# Post fields that can be asked for with ?fields=, 'author' is the id of an entry in the 'authors' object of the response
+POST_FIELDS = {
+    'id': Post.id,
+    'body': Post.body,
+    'timestamp': Post.timestamp,
+    'language': Post.language,
+    'author': Post.user_id,
+}
+
+
+def requested_fields():
+    fields = request.args.get('fields')
+    if not fields:
+        return list(POST_FIELDS)
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in POST_FIELDS]
+    if unknown or not fields:
+        return None
+    return fields
+
+
+# Feed page as compact JSON
+# Only the requested columns are selected, and rows go straight to dictionaries without building Post objects or rendering templates
+# Each author is sent once, in 'authors', however many of their posts are on the page
+def feed_response(query, endpoint, **values):
+    fields = requested_fields()
+    if fields is None:
+        return bad_request('fields must be a comma separated list of: ' +
+                           ', '.join(POST_FIELDS))
+    per_page = min(request.args.get('limit', current_app.config[
+        'POSTS_PER_PAGE'], type=int), current_app.config['API_MAX_PER_PAGE'])
+    if per_page < 1:
+        return bad_request('limit must be a positive number')
+    page = keyset_paginate(
+        query.with_only_columns(*[POST_FIELDS[field] for field in fields]),
+        (Post.timestamp, Post.id), per_page)
+    rows = page.items if len(fields) > 1 else [(item,) for item in page.items]
+    timestamp = fields.index('timestamp') if 'timestamp' in fields else None
+    posts = []
+    for row in rows:
+        post = dict(zip(fields, row))
+        if timestamp is not None:
+            post['timestamp'] = row[timestamp].replace(
+                tzinfo=timezone.utc).isoformat()
+        posts.append(post)
+    data = {'posts': posts}
+    if 'author' in fields:
+        ids = {post['author'] for post in posts}
+        authors = db.session.execute(
+            sa.select(User.id, User.username, User.email)
+            .where(User.id.in_(ids))) if ids else []
+        data['authors'] = {
+            str(id): {'id': id, 'username': username,
+                      'avatar': avatar_url(email, 48)}
+            for id, username, email in authors}
+    if request.args.get('fields'):
+        values['fields'] = request.args['fields']
+    if 'limit' in request.args:
+        values['limit'] = per_page
+    data['next'] = page.next_url(endpoint, **values)
+    data['prev'] = page.prev_url(endpoint, **values)
+    return current_app.response_class(
+        json.dumps(data, separators=(',', ':'), ensure_ascii=False),
+        mimetype='application/json')
+
+
+@bp.route('/timeline/home')
+@token_auth_required
+@read_replica
+def home_timeline():
+    return feed_response(g.api_user.home_posts(), 'api.home_timeline')
+
+
+@bp.route('/timeline/explore')
+@token_auth_required
+@read_replica
+def explore_timeline():
+    return feed_response(sa.select(Post), 'api.explore_timeline')
+
+
+@bp.route('/users/<username>/posts')
+@token_auth_required
+@read_replica
+def user_timeline(username):
+    user = db.first_or_404(sa.select(User).where(User.username == username))
+    return feed_response(user.posts.select(), 'api.user_timeline',
+                         username=user.username)
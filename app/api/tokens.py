@@ -0,0 +1,23 @@
+from flask import current_app, g
+from app import db
+from app.api import bp
+from app.api.auth import basic_auth_required, token_auth_required
+from app.ratelimit import limiter
+
+
+# Checks a password like the login form, so it shares its limit on failed guesses per address
+@bp.route('/tokens', methods=['POST'])
+@limiter.limit('RATELIMIT_LOGIN', by='ip', algorithm='sliding_window')
+@basic_auth_required
+def get_token():
+    token = g.api_user.get_token(current_app.config['API_TOKEN_EXPIRATION'])
+    db.session.commit()
+    return {'token': token}
+
+
+@bp.route('/tokens', methods=['DELETE'])
+@token_auth_required
+def revoke_token():
+    g.api_user.revoke_token()
+    db.session.commit()
+    return '', 204
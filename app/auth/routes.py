@@ -9,8 +9,12 @@ from app.auth.forms import LoginForm, RegistrationForm, \
     ResetPasswordRequestForm, ResetPasswordForm
 from app.models import User
 from app.auth.email import send_password_reset_email
+from app.user_cache import cache as user_cache
+from app.passwords import hasher as password_hasher
+from app.ratelimit import limiter
 
 @bp.route('/login', methods=['GET', 'POST'])
+@limiter.limit('RATELIMIT_LOGIN', by='ip', algorithm='sliding_window')
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('main.index'))
@@ -21,6 +25,10 @@ def login():
         if user is None or not user.check_password(form.password.data):
             flash(_('Invalid username or password'))
             return redirect(url_for('auth.login'))
+        # Hashes made with an older PASSWORD_HASH_METHOD are upgraded while the plain password is at hand
+        if password_hasher.needs_rehash(user.password_hash):
+            password_hasher.rehash(user.id, user.password_hash,
+                                   form.password.data)
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if not next_page or urlsplit(next_page).netloc != '':
@@ -31,6 +39,8 @@ def login():
 
 @bp.route('/logout')
 def logout():
+    if current_user.is_authenticated:
+        user_cache.invalidate(current_user.id)
     logout_user()
     return redirect(url_for('main.index'))
 
@@ -51,6 +61,8 @@ def register():
 
 
 @bp.route('/reset_password_request', methods=['GET', 'POST'])
+@limiter.limit('RATELIMIT_RESET_PASSWORD', by='ip',
+               algorithm='sliding_window')
 def reset_password_request():
     if current_user.is_authenticated:
         return redirect(url_for('main.index'))
@@ -78,6 +90,7 @@ def reset_password(token):
     if form.validate_on_submit():
         user.set_password(form.password.data)
         db.session.commit()
+        user_cache.invalidate(user.id)
         flash(_('Your password has been reset.'))
         return redirect(url_for('auth.login'))
     return render_template('auth/reset_password.html', form=form)
\ No newline at end of file
@@ -0,0 +1,155 @@
+import csv
+import io
+import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from datetime import datetime
+from itertools import islice
+import sqlalchemy as sa
+from flask import current_app
+from werkzeug.security import generate_password_hash
+from app import db
+from app.language import detect_language
+from app.models import User, Post, followers
+
+# Bulk import/export of the user, post and followers tables as JSON Lines or CSV
+# Rows are streamed in chunks and written with Core executemany INSERTs, so memory use doesn't depend on the size of the file
+TABLES = {
+    'user': User.__table__,
+    'post': Post.__table__,
+    'followers': followers,
+}
+
+FORMATS = ['jsonl', 'csv']
+
+# API bearer tokens are live credentials, they are never exported or imported
+EXCLUDED_COLUMNS = {'user': {'token', 'token_expiration'}}
+# Only exported when asked for (--include-secrets), an import takes them when present
+SECRET_COLUMNS = {'user': {'password_hash'}}
+
+
+def columns(table, include_secrets=False):
+    excluded = EXCLUDED_COLUMNS.get(table, set())
+    if not include_secrets:
+        excluded = excluded | SECRET_COLUMNS.get(table, set())
+    return [column for column in TABLES[table].c if column.key not in excluded]
+
+
+def guess_format(filename):
+    return 'csv' if filename.lower().endswith('.csv') else 'jsonl'
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_rows(file, format):
+    if format == 'csv':
+        for row in csv.DictReader(file):
+            yield {key: value for key, value in row.items() if value != ''}
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+# Serializes rows one at a time, used by the export command and the post download view
+def to_json(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(row, default=to_json, ensure_ascii=False) + '\n'
+
+
+# The first line is the header
+def csv_lines(rows, columns):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+    writer.writeheader()
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    for row in rows:
+        writer.writerow({key: value.isoformat()
+                         if isinstance(value, datetime) else value
+                         for key, value in row.items()})
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def parse_datetime(row, column):
+    if isinstance(row.get(column), str):
+        row[column] = datetime.fromisoformat(row[column])
+
+
+# Turns imported records into table rows, CPU heavy work (password hashing, language detection) runs on the process pool
+def prepare(table, records, pool, defer_language):
+    keys = {column.key for column in columns(table, include_secrets=True)}
+    if table == 'user':
+        passwords = [record.pop('password', None) for record in records]
+        todo = [i for i, password in enumerate(passwords)
+                if password is not None]
+        hash_password = partial(
+            generate_password_hash,
+            method=current_app.config['PASSWORD_HASH_METHOD'],
+            salt_length=current_app.config['PASSWORD_SALT_LENGTH'])
+        hashes = pool.map(hash_password, [passwords[i] for i in todo],
+                          chunksize=64)
+        for i, password_hash in zip(todo, hashes):
+            records[i]['password_hash'] = password_hash
+        for record in records:
+            parse_datetime(record, 'last_seen')
+    elif table == 'post':
+        for record in records:
+            parse_datetime(record, 'timestamp')
+        if not defer_language:
+            todo = [i for i, record in enumerate(records)
+                    if record.get('language') is None]
+            languages = pool.map(detect_language,
+                                 [records[i]['body'] for i in todo],
+                                 chunksize=64)
+            for i, language in zip(todo, languages):
+                records[i]['language'] = language
+    return [{key: value for key, value in record.items() if key in keys}
+            for record in records]
+
+
+# Yields the number of rows written after each chunk
+def import_rows(table, records, chunk_size=1000, workers=None,
+                defer_language=False):
+    insert = TABLES[table].insert()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for chunk in chunks(records, chunk_size):
+            rows = prepare(table, chunk, pool, defer_language)
+            # executemany needs every row to have the same keys
+            for keys, group in group_by_keys(rows):
+                db.session.execute(insert, group)
+            db.session.commit()
+            yield len(rows)
+
+
+def group_by_keys(rows):
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    return groups.items()
+
+
+# Streams the rows of a table with a server side cursor, yielding dictionaries
+def export_rows(table, chunk_size=1000, include_secrets=False):
+    query = sa.select(*columns(table, include_secrets)).order_by(
+        *TABLES[table].primary_key.columns)
+    result = db.session.execute(
+        query, execution_options={'yield_per': chunk_size})
+    for row in result.mappings():
+        yield dict(row)
@@ -1,6 +1,13 @@
 import os
-from flask import Blueprint
+from datetime import datetime, timezone
+from time import time
+from flask import Blueprint, current_app
 import click
+import sqlalchemy as sa
+from app import db
+from app.models import User, Post, followers, suggestion, timeline as inbox
+from app.language import detect_language, save_languages
+from app import bulk
 
 bp = Blueprint('cli', __name__, cli_group=None)
 
@@ -37,3 +44,252 @@ def compile():
     """Compile all languages."""
     if os.system('pybabel compile -d app/translations'):
         raise RuntimeError('compile command failed')
+
+
+@bp.cli.group()
+def timeline():
+    """Home timeline store commands."""
+    pass
+
+
+@timeline.command()
+def rebuild():
+    """Rebuild every user's timeline inbox from the followers graph."""
+    limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+    backfill = current_app.config['TIMELINE_BACKFILL']
+    # Only the most recent posts of each author are delivered, same as a follow
+    recent = sa.select(
+        Post.id, Post.user_id,
+        sa.func.row_number().over(
+            partition_by=Post.user_id,
+            order_by=Post.timestamp.desc()).label('position')
+    ).subquery()
+    celebrities = sa.select(User.id).where(User.num_followers > limit)
+    db.session.execute(inbox.delete())
+    db.session.execute(inbox.insert().from_select(
+        ['user_id', 'post_id'],
+        sa.select(recent.c.user_id, recent.c.id)
+        .where(recent.c.position <= backfill)))
+    db.session.execute(inbox.insert().from_select(
+        ['user_id', 'post_id'],
+        sa.select(followers.c.follower_id, recent.c.id)
+        .join(recent, recent.c.user_id == followers.c.followed_id)
+        .where(recent.c.position <= backfill,
+               followers.c.followed_id.not_in(celebrities))))
+    db.session.commit()
+    click.echo('Timeline rebuilt.')
+
+
+@bp.cli.group()
+def counters():
+    """Denormalized counter commands."""
+    pass
+
+
+@counters.command()
+@click.option('--batch-size', default=10000,
+              help='Number of users checked per transaction.')
+def repair(batch_size):
+    """Recompute the follower, following and post counters of every user."""
+    actual = {
+        'num_followers': sa.select(sa.func.count()).where(
+            followers.c.followed_id == User.id).scalar_subquery(),
+        'num_following': sa.select(sa.func.count()).where(
+            followers.c.follower_id == User.id).scalar_subquery(),
+        'num_posts': sa.select(sa.func.count()).where(
+            Post.user_id == User.id).scalar_subquery(),
+    }
+    stale = sa.or_(*[getattr(User, name) != value
+                     for name, value in actual.items()])
+    last_id = db.session.scalar(sa.select(sa.func.max(User.id))) or 0
+    repaired = 0
+    # Users are processed in id ranges so each transaction stays short
+    for start in range(0, last_id, batch_size):
+        result = db.session.execute(
+            sa.update(User)
+            .where(User.id > start, User.id <= start + batch_size, stale)
+            .values(**actual)
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+        repaired += result.rowcount
+    click.echo('Repaired the counters of {} users.'.format(repaired))
+
+
+@bp.cli.group()
+def suggestions():
+    """Who to follow suggestion commands."""
+    pass
+
+
+@suggestions.command('rebuild')
+@click.option('--batch-size', default=1000,
+              help='Number of users whose suggestions are rebuilt per transaction.')
+def rebuild_suggestions(batch_size):
+    """Recompute every user's suggestions from the followers graph."""
+    limit = current_app.config['SUGGESTIONS_FANOUT_LIMIT']
+    per_user = current_app.config['SUGGESTIONS_PER_USER']
+    followed = followers.alias('followed')
+    second = followers.alias('second')
+    already = followers.alias('already')
+    last_id = db.session.scalar(sa.select(sa.func.max(User.id))) or 0
+    total = 0
+    # Users are processed in id ranges, the two-hop join, the counts and the ranking all run in the database, so memory use depends
+    # on the batch size and not on the size of the graph
+    # Accounts following more than SUGGESTIONS_FANOUT_LIMIT users are skipped as the middle hop, which bounds the rows a batch expands to
+    with click.progressbar(range(0, last_id, batch_size),
+                           label='Rebuilding suggestions') as bar:
+        for start in bar:
+            in_batch = sa.and_(followed.c.follower_id > start,
+                               followed.c.follower_id <= start + batch_size)
+            candidates = (
+                sa.select(followed.c.follower_id.label('user_id'),
+                          second.c.followed_id.label('suggested_id'),
+                          sa.func.count().label('score'))
+                .join(second, second.c.follower_id == followed.c.followed_id)
+                .join(User, User.id == followed.c.followed_id)
+                .where(in_batch, User.num_following <= limit,
+                       second.c.followed_id != followed.c.follower_id,
+                       ~sa.select(already).where(
+                           already.c.follower_id == followed.c.follower_id,
+                           already.c.followed_id == second.c.followed_id)
+                       .exists())
+                .group_by(followed.c.follower_id, second.c.followed_id)
+                .subquery()
+            )
+            ranked = sa.select(
+                candidates,
+                sa.func.row_number().over(
+                    partition_by=candidates.c.user_id,
+                    order_by=(candidates.c.score.desc(),
+                              candidates.c.suggested_id)).label('position')
+            ).subquery()
+            db.session.execute(suggestion.delete().where(
+                suggestion.c.user_id > start,
+                suggestion.c.user_id <= start + batch_size))
+            result = db.session.execute(suggestion.insert().from_select(
+                ['user_id', 'suggested_id', 'score'],
+                sa.select(ranked.c.user_id, ranked.c.suggested_id,
+                          ranked.c.score)
+                .where(ranked.c.position <= per_user)))
+            db.session.execute(sa.update(User).where(
+                User.id > start, User.id <= start + batch_size)
+                .values(updated=datetime.now(timezone.utc)))
+            db.session.commit()
+            total += result.rowcount
+    click.echo('Stored {} suggestions.'.format(total))
+
+
+@bp.cli.group()
+def language():
+    """Post language detection commands."""
+    pass
+
+
+@language.command()
+@click.option('--all', 'redetect', is_flag=True,
+              help='Detect every post again, not only the pending ones.')
+@click.option('--chunk-size', default=1000,
+              help='Number of posts detected per transaction.')
+def backfill(redetect, chunk_size):
+    """Detect the language of posts saved without one."""
+    query = sa.select(Post.id, Post.body).order_by(Post.id)
+    if not redetect:
+        query = query.where(Post.language.is_(None))
+    total = db.session.scalar(
+        sa.select(sa.func.count()).select_from(query.subquery()))
+    last_id = 0
+    # Posts are walked in id order, one chunk per transaction
+    with click.progressbar(length=total, label='Detecting languages') as bar:
+        while True:
+            rows = db.session.execute(
+                query.where(Post.id > last_id).limit(chunk_size)).all()
+            if not rows:
+                break
+            save_languages(db.session.connection(),
+                           [(row.id, detect_language(row.body))
+                            for row in rows])
+            db.session.commit()
+            last_id = rows[-1].id
+            bar.update(len(rows))
+    click.echo('Detected the language of {} posts.'.format(total))
+
+
+@bp.cli.group()
+def search():
+    """Full-text search index commands."""
+    pass
+
+
+@search.command('rebuild')
+@click.option('--optimize', is_flag=True,
+              help='Merge the index b-trees after rebuilding.')
+def rebuild_search(optimize):
+    """Rebuild the post search index from the post table."""
+    db.session.execute(sa.text(
+        "INSERT INTO post_fts(post_fts) VALUES ('rebuild')"))
+    if optimize:
+        db.session.execute(sa.text(
+            "INSERT INTO post_fts(post_fts) VALUES ('optimize')"))
+    db.session.commit()
+    click.echo('Search index rebuilt.')
+
+
+@bp.cli.group()
+def data():
+    """Bulk data import and export commands."""
+    pass
+
+
+@data.command('import')
+@click.argument('table', type=click.Choice(list(bulk.TABLES)))
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@click.option('--format', type=click.Choice(bulk.FORMATS),
+              help='Input format, guessed from the file name by default.')
+@click.option('--chunk-size', default=1000,
+              help='Number of rows inserted per transaction.')
+@click.option('--workers', type=int,
+              help='Processes used to hash passwords and detect languages.')
+@click.option('--defer-language', is_flag=True,
+              help="Leave post languages pending for 'flask language "
+                   "backfill'.")
+def import_data(table, file, format, chunk_size, workers, defer_language):
+    """Import rows into a table from a JSON Lines or CSV file."""
+    format = format or bulk.guess_format(file.name)
+    start = time()
+    total = 0
+    for count in bulk.import_rows(table, bulk.read_rows(file, format),
+                                  chunk_size, workers, defer_language):
+        total += count
+        click.echo('{} rows imported ({:.0f} rows/sec)'.format(
+            total, total / max(time() - start, 1e-9)))
+    click.echo('Imported {} rows into {} in {:.1f}s ({:.0f} rows/sec).'.format(
+        total, table, time() - start, total / max(time() - start, 1e-9)))
+    if table != 'user':
+        click.echo("Run 'flask counters repair' to update the user counters.")
+
+
+@data.command('export')
+@click.argument('table', type=click.Choice(list(bulk.TABLES)))
+@click.argument('file', type=click.File('w', encoding='utf-8'))
+@click.option('--format', type=click.Choice(bulk.FORMATS),
+              help='Output format, guessed from the file name by default.')
+@click.option('--chunk-size', default=1000,
+              help='Number of rows fetched at a time.')
+@click.option('--include-secrets', is_flag=True,
+              help='Also export password hashes.')
+def export_data(table, file, format, chunk_size, include_secrets):
+    """Export the rows of a table to a JSON Lines or CSV file."""
+    format = format or bulk.guess_format(file.name)
+    start = time()
+    rows = bulk.export_rows(table, chunk_size, include_secrets)
+    if format == 'csv':
+        lines = bulk.csv_lines(rows, [column.key for column in bulk.columns(
+            table, include_secrets)])
+    else:
+        lines = bulk.jsonl_lines(rows)
+    total = -1 if format == 'csv' else 0
+    for line in lines:
+        file.write(line)
+        total += 1
+    click.echo('Exported {} rows from {} in {:.1f}s ({:.0f} rows/sec).'.format(
+        total, table, time() - start, total / max(time() - start, 1e-9)))
@@ -0,0 +1,53 @@
+import json
+from datetime import timezone
+from hashlib import sha1
+from time import time
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+
+
+# Most recent of some timestamps, SQLite returns them without a time zone, they are UTC
+def latest(*timestamps):
+    return max((timestamp if timestamp.tzinfo else
+                timestamp.replace(tzinfo=timezone.utc)
+                for timestamp in timestamps if timestamp is not None),
+               default=None)
+
+
+# Validators (ETag and Last-Modified) of a page, worked out from cheap values before the page is rendered
+# The ETag covers the values given by the view plus everything else the page shows: the viewer, the locale and the CSRF token of its forms,
+# which is renewed every half WTF_CSRF_TIME_LIMIT so a revalidated page never carries an expired token
+# Pages with flashed messages waiting to be shown are always rendered
+class PageValidators:
+    def __init__(self, *values, last_modified=None):
+        viewer = None
+        if current_user.is_authenticated:
+            viewer = (current_user.id, current_user.username)
+        time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+        csrf_period = int(time() // (time_limit / 2)) if time_limit else None
+        key = json.dumps([values, viewer, g.get('locale'),
+                          session.get('csrf_token'), csrf_period],
+                         default=str)
+        self.etag = sha1(key.encode()).hexdigest()
+        self.last_modified = last_modified
+
+    def not_modified(self):
+        if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+            return False
+        return not is_resource_modified(request.environ, etag=self.etag,
+                                        last_modified=self.last_modified)
+
+    def not_modified_response(self):
+        return self.apply(current_app.response_class(status=304))
+
+    # Browsers revalidate on every visit, and the page is only stored by the viewer's own browser
+    def apply(self, response):
+        response = make_response(response)
+        response.set_etag(self.etag, weak=True)
+        if self.last_modified is not None:
+            response.last_modified = self.last_modified
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.update(('Cookie', 'Accept-Language'))
+        return response
@@ -1,16 +1,148 @@
-from threading import Thread
-from flask import current_app
+import atexit
+from queue import Queue, Empty, Full
+from threading import Lock, Thread
+from time import monotonic, sleep
 from flask_mail import Message
 from app import mail
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+# Bounded outbound mail queue served by a fixed pool of worker threads
+# Each worker keeps its SMTP connection open while there is mail to send and closes it after MAIL_IDLE_TIMEOUT idle seconds
+# When the queue is full, senders wait up to MAIL_QUEUE_TIMEOUT seconds for room (backpressure) before the message is rejected
+# Queued mail is sent before the process exits, waiting at most MAIL_SHUTDOWN_TIMEOUT seconds for it
+class MailQueue:
+    # Put on the queue once per worker by stop(), after the mail already queued
+    STOP = object()
+
+    def __init__(self, app=None):
+        self.app = None
+        self.queue = None
+        self.workers = []
+        self.lock = Lock()
+        atexit.register(self.stop)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # The workers of a previous application finish its mail and exit
+        self.stop()
+        self.app = app
+        app.extensions['mail_queue'] = self
+        self.queue = Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+        self.workers = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rejected = 0
+
+    def send(self, msg):
+        self.start()
+        try:
+            self.queue.put(msg, timeout=self.app.config['MAIL_QUEUE_TIMEOUT'])
+        except Full:
+            with self.lock:
+                self.rejected += 1
+            self.app.logger.error('Mail queue full, dropped message %r',
+                                  msg.subject)
+            return False
+        return True
+
+    def start(self):
+        with self.lock:
+            if self.workers:
+                return
+            for i in range(self.app.config['MAIL_WORKERS']):
+                worker = Thread(target=self.run, args=(self.app, self.queue),
+                                daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def run(self, app, queue):
+        connection = None
+        with app.app_context():
+            while True:
+                try:
+                    msg = queue.get(
+                        timeout=app.config['MAIL_IDLE_TIMEOUT']
+                        if connection is not None else None)
+                except Empty:
+                    connection = self.disconnect(connection)
+                    continue
+                if msg is self.STOP:
+                    self.disconnect(connection)
+                    queue.task_done()
+                    return
+                connection = self.deliver(connection, msg)
+                queue.task_done()
+
+    # Lets the workers send what is queued and waits for them to exit, for at most MAIL_SHUTDOWN_TIMEOUT seconds
+    # The workers are daemon threads, so an unreachable mail server can't keep the process from exiting past that
+    def stop(self):
+        with self.lock:
+            workers, self.workers = self.workers, []
+        if not workers:
+            return
+        deadline = monotonic() + self.app.config['MAIL_SHUTDOWN_TIMEOUT']
+        try:
+            for worker in workers:
+                self.queue.put(self.STOP,
+                               timeout=max(deadline - monotonic(), 0))
+        except Full:
+            pass
+        for worker in workers:
+            worker.join(timeout=max(deadline - monotonic(), 0))
+        if any(worker.is_alive() for worker in workers):
+            self.app.logger.error('Mail queue stopped with messages unsent')
+
+    # Sends one message, reconnecting and retrying with exponential backoff when the SMTP conversation fails
+    # Returns the connection to use for the next message
+    def deliver(self, connection, msg):
+        retries = self.app.config['MAIL_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                if connection is None:
+                    connection = mail.connect()
+                    connection.__enter__()
+                connection.send(msg)
+                with self.lock:
+                    self.sent += 1
+                return connection
+            except Exception:
+                connection = self.disconnect(connection)
+                if attempt == retries:
+                    with self.lock:
+                        self.failed += 1
+                    self.app.logger.exception('Failed to send message %r',
+                                              msg.subject)
+                else:
+                    with self.lock:
+                        self.retried += 1
+                    sleep(self.app.config['MAIL_RETRY_DELAY'] * 2 ** attempt)
+        return connection
+
+    def disconnect(self, connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except Exception:
+                pass
+        return None
+
+    # Blocks until every queued message has been delivered or given up on
+    def join(self):
+        self.queue.join()
+
+    def stats(self):
+        with self.lock:
+            return {'depth': self.queue.qsize(), 'workers': len(self.workers),
+                    'sent': self.sent, 'failed': self.failed,
+                    'retried': self.retried, 'rejected': self.rejected}
+
+
+mail_queue = MailQueue()
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
-
+    return mail_queue.send(msg)
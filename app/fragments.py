@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from threading import Lock
+from flask import g, render_template
+from markupsafe import Markup
+
+# Cache of rendered _post.html fragments
+# A post never changes once written, so its HTML only depends on the post, its detected language, the author's username and the locale of the page
+# Entries are kept in a bounded LRU, and an author's entries are dropped when they change username
+# The username is part of the key too, so stale fragments are never served by other worker processes either
+class FragmentCache:
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.authors = {}
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['fragment_cache'] = self
+        app.jinja_env.globals['render_post'] = self.render_post
+        self.clear()
+
+    # Used by the feed templates in place of {% include '_post.html' %}
+    def render_post(self, post):
+        if not self.app.config['FRAGMENT_CACHE_ENABLED']:
+            return Markup(render_template('_post.html', post=post))
+        key = (post.id, post.language, post.author.username, g.locale)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        fragment = Markup(render_template('_post.html', post=post))
+        with self.lock:
+            self.entries[key] = (post.user_id, fragment)
+            self.authors.setdefault(post.user_id, set()).add(key)
+            while len(self.entries) > self.app.config['FRAGMENT_CACHE_SIZE']:
+                key, (user_id, html) = self.entries.popitem(last=False)
+                keys = self.authors[user_id]
+                keys.discard(key)
+                if not keys:
+                    del self.authors[user_id]
+        return fragment
+
+    def invalidate_author(self, user_id):
+        with self.lock:
+            for key in self.authors.pop(user_id, ()):
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.authors.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits,
+                    'misses': self.misses}
+
+
+fragment_cache = FragmentCache()
@@ -0,0 +1,170 @@
+import json
+from bisect import bisect_left
+from collections import deque
+from datetime import datetime, timezone
+from threading import Lock
+from time import perf_counter
+import sqlalchemy as sa
+from flask import Blueprint, abort, current_app, g, has_request_context, \
+    request, request_started, before_render_template, template_rendered
+from flask_login import current_user
+from app import db
+
+# Latency histogram buckets, in milliseconds
+BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+bp = Blueprint('instrumentation', __name__)
+
+
+# Opt-in per-request instrumentation (INSTRUMENTATION_ENABLED)
+# Counts the SQL statements and database time of each request through SQLAlchemy engine events and the template render time through Flask signals,
+# then reports them in a Server-Timing header and one structured log line per request, and aggregates them per endpoint
+class Instrumentation:
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = Lock()
+        self.endpoints = {}
+        self.slow_queries = deque()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['INSTRUMENTATION_ENABLED']:
+            return
+        self.app = app
+        app.extensions['instrumentation'] = self
+        with self.lock:
+            self.endpoints = {}
+            self.slow_queries = deque(
+                maxlen=app.config['INSTRUMENTATION_SLOW_QUERY_SAMPLES'])
+        with app.app_context():
+            for engine in db.engines.values():
+                sa.event.listen(engine, 'before_cursor_execute',
+                                self.before_cursor_execute)
+                sa.event.listen(engine, 'after_cursor_execute',
+                                self.after_cursor_execute)
+        request_started.connect(self.request_started, app)
+        before_render_template.connect(self.before_render_template, app)
+        template_rendered.connect(self.template_rendered, app)
+        app.after_request(self.after_request)
+        app.register_blueprint(bp)
+
+    def request_started(self, sender, **extra):
+        g.instrumentation = {'start': perf_counter(), 'queries': 0,
+                             'sql_time': 0.0, 'render_time': 0.0,
+                             'templates': []}
+
+    @staticmethod
+    def current():
+        if has_request_context():
+            return g.get('instrumentation')
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        conn.info.setdefault('query_start', []).append(perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        elapsed = perf_counter() - conn.info['query_start'].pop()
+        stats = self.current()
+        if stats is None:
+            return
+        stats['queries'] += 1
+        stats['sql_time'] += elapsed
+        if elapsed >= self.app.config['INSTRUMENTATION_SLOW_QUERY']:
+            with self.lock:
+                self.slow_queries.append({
+                    'endpoint': request.endpoint,
+                    'statement': statement,
+                    'ms': round(elapsed * 1000, 3),
+                    'timestamp': datetime.now(timezone.utc).isoformat(),
+                })
+
+    # Templates rendered from inside another template (such as post fragments) are part of the outer render time
+    def before_render_template(self, sender, template, context, **extra):
+        stats = self.current()
+        if stats is not None:
+            stats['templates'].append(perf_counter())
+
+    def template_rendered(self, sender, template, context, **extra):
+        stats = self.current()
+        if stats is not None and stats['templates']:
+            start = stats['templates'].pop()
+            if not stats['templates']:
+                stats['render_time'] += perf_counter() - start
+
+    def after_request(self, response):
+        stats = self.current()
+        if stats is None:
+            return response
+        duration = (perf_counter() - stats['start']) * 1000
+        sql_ms = stats['sql_time'] * 1000
+        render_ms = stats['render_time'] * 1000
+        endpoint = request.endpoint or 'unknown'
+        response.headers.add(
+            'Server-Timing',
+            'db;dur={:.2f};desc="{} queries", tpl;dur={:.2f}, '
+            'total;dur={:.2f}'.format(sql_ms, stats['queries'], render_ms,
+                                      duration))
+        fields = {
+            'event': 'request',
+            'method': request.method,
+            'path': request.path,
+            'endpoint': endpoint,
+            'status': response.status_code,
+            'ms': round(duration, 3),
+            'queries': stats['queries'],
+            'sql_ms': round(sql_ms, 3),
+            'render_ms': round(render_ms, 3),
+        }
+        self.app.logger.info(json.dumps(fields), extra={'fields': fields})
+        with self.lock:
+            totals = self.endpoints.setdefault(endpoint, {
+                'requests': 0, 'queries': 0, 'ms': 0.0, 'sql_ms': 0.0,
+                'render_ms': 0.0, 'histogram': [0] * (len(BUCKETS) + 1)})
+            totals['requests'] += 1
+            totals['queries'] += stats['queries']
+            totals['ms'] += duration
+            totals['sql_ms'] += sql_ms
+            totals['render_ms'] += render_ms
+            totals['histogram'][bisect_left(BUCKETS, duration)] += 1
+        return response
+
+    def stats(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, totals in self.endpoints.items():
+                requests = totals['requests']
+                endpoints[endpoint] = {
+                    'requests': requests,
+                    'queries_per_request': round(
+                        totals['queries'] / requests, 2),
+                    'avg_ms': round(totals['ms'] / requests, 3),
+                    'avg_sql_ms': round(totals['sql_ms'] / requests, 3),
+                    'avg_render_ms': round(totals['render_ms'] / requests, 3),
+                    'histogram_ms': {
+                        ('<={}'.format(bound) if bound is not None else
+                         '>{}'.format(BUCKETS[-1])): count
+                        for bound, count in zip(BUCKETS + [None],
+                                                totals['histogram'])},
+                }
+            return {'endpoints': endpoints,
+                    'slow_queries': list(self.slow_queries)}
+
+
+instrumentation = Instrumentation()
+
+
+# Aggregated request metrics plus the counters of the in-process caches and queues, only for the addresses listed in ADMINS
+@bp.route('/admin/metrics')
+def metrics():
+    if not current_user.is_authenticated or \
+            current_user.email not in current_app.config['ADMINS']:
+        abort(403)
+    data = instrumentation.stats()
+    for name in ['translation_cache', 'fragment_cache', 'user_cache',
+                 'mail_queue', 'password_hasher', 'log_pipeline',
+                 'post_stream', 'rate_limiter']:
+        if name in current_app.extensions:
+            data[name] = current_app.extensions[name].stats()
+    return data
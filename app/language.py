@@ -0,0 +1,109 @@
+from datetime import datetime, timezone
+from queue import Queue, Empty, Full
+from threading import Lock, Thread
+import sqlalchemy as sa
+from langdetect import DetectorFactory, detect, LangDetectException
+from app import db
+from app.models import User, Post
+
+# A fixed seed makes langdetect return the same language for the same text every time
+DetectorFactory.seed = 0
+
+
+def detect_language(text):
+    try:
+        return detect(text)
+    except LangDetectException:
+        return ''
+
+
+# Writes detected languages as one executemany UPDATE, 'results' is a list of (post id, language) pairs
+# The authors are stamped as updated, a post with a language shows a Translate link on their cached pages
+def save_languages(connection, results):
+    table = Post.__table__
+    connection.execute(
+        table.update()
+        .where(table.c.id == sa.bindparam('post_id'))
+        .values(language=sa.bindparam('detected')),
+        [{'post_id': post_id, 'detected': language}
+         for post_id, language in results])
+    users = User.__table__
+    connection.execute(
+        users.update()
+        .where(users.c.id.in_(sa.select(table.c.user_id).where(
+            table.c.id.in_([post_id for post_id, _ in results]))))
+        .values(updated=datetime.now(timezone.utc)))
+
+
+# Detects the language of new posts off the request path
+# Posts are saved with a pending (NULL) language and queued here, a fixed pool of worker threads detects them in batches and updates the post table
+# When the queue is full, or the process exits with posts still queued, they stay pending until 'flask language backfill' runs
+class LanguageDetector:
+    def __init__(self, app=None):
+        self.app = None
+        self.queue = None
+        self.workers = []
+        self.lock = Lock()
+        self.warm_up_lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['language_detector'] = self
+        self.queue = Queue(maxsize=app.config['LANGUAGE_QUEUE_SIZE'])
+        self.workers = []
+
+    # Called once the post has been committed
+    def submit(self, post):
+        if not self.app.config['LANGUAGE_DETECTION_WORKERS']:
+            with db.engine.begin() as connection:
+                save_languages(connection,
+                               [(post.id, detect_language(post.body))])
+            return
+        self.start()
+        try:
+            self.queue.put_nowait((post.id, post.body))
+        except Full:
+            self.app.logger.warning(
+                'Language detection queue full, post %d left pending', post.id)
+
+    def start(self):
+        with self.lock:
+            if self.workers:
+                return
+            for i in range(self.app.config['LANGUAGE_DETECTION_WORKERS']):
+                worker = Thread(target=self.run, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def run(self):
+        # langdetect loads its language profiles on first use, this happens here instead of in a request
+        # One worker loads them while the others wait, submit() doesn't wait on this lock and can queue posts meanwhile
+        with self.warm_up_lock:
+            detect_language('warm up')
+        batch_size = self.app.config['LANGUAGE_BATCH_SIZE']
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                results = [(post_id, detect_language(body))
+                           for post_id, body in batch]
+                with self.app.app_context(), db.engine.begin() as connection:
+                    save_languages(connection, results)
+            except Exception:
+                self.app.logger.exception('Language detection failed')
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+
+    # Blocks until every queued post has been processed
+    def join(self):
+        self.queue.join()
+
+
+detector = LanguageDetector()
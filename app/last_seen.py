@@ -0,0 +1,77 @@
+import atexit
+from datetime import datetime, timedelta, timezone
+from threading import Lock, Timer
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from app import db
+from app.models import User
+from app.user_cache import cache as user_cache
+
+
+# Coalesces the 'last seen' timestamps of logged in users
+# A timestamp is only recorded when the stored one is older than LAST_SEEN_GRANULARITY, and recorded timestamps are buffered in memory and written with one bulk UPDATE
+# when LAST_SEEN_BATCH_SIZE users are pending or LAST_SEEN_FLUSH_INTERVAL seconds after the first one was buffered, whichever comes first
+class LastSeenTracker:
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = Lock()
+        self.pending = {}
+        self.timer = None
+        # Whatever is still buffered is written when the process exits, registered once however many apps the tracker serves
+        atexit.register(self.flush_in_context)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['last_seen'] = self
+
+    def touch(self, user):
+        now = datetime.now(timezone.utc)
+        granularity = timedelta(
+            seconds=self.app.config['LAST_SEEN_GRANULARITY'])
+        seen = user.last_seen
+        if seen is not None and seen.tzinfo is None:
+            seen = seen.replace(tzinfo=timezone.utc)
+        if seen is not None and now - seen < granularity:
+            return
+        # The loaded user shows the new value without being marked as modified, so no write happens when the request session commits
+        so.attributes.set_committed_value(user, 'last_seen', now)
+        user_cache.update(user.id, last_seen=now)
+        with self.lock:
+            self.pending[user.id] = now
+            full = len(self.pending) >= self.app.config['LAST_SEEN_BATCH_SIZE']
+            if not full and self.timer is None:
+                self.timer = Timer(self.app.config['LAST_SEEN_FLUSH_INTERVAL'],
+                                   self.flush_in_context)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+
+    # Writes all buffered timestamps in a single executemany UPDATE on its own connection
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if not pending:
+            return
+        table = User.__table__
+        with db.engine.begin() as connection:
+            connection.execute(
+                table.update()
+                .where(table.c.id == sa.bindparam('user_id'))
+                .values(last_seen=sa.bindparam('seen')),
+                [{'user_id': user_id, 'seen': seen}
+                 for user_id, seen in pending.items()])
+
+    def flush_in_context(self):
+        if not self.pending:
+            return
+        with self.app.app_context():
+            self.flush()
+
+
+tracker = LastSeenTracker()
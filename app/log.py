@@ -0,0 +1,192 @@
+import atexit
+import copy
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, \
+    SMTPHandler
+from queue import Queue, Full
+from time import monotonic
+from flask import has_request_context, request
+
+
+# One JSON object per line, with the request method and path when the record was logged during a request
+# Records logged with extra={'fields': {...}} have those fields added to the object
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc)
+            .isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'location': '{}:{}'.format(record.pathname, record.lineno),
+        }
+        for key in ('method', 'path'):
+            if hasattr(record, key):
+                entry[key] = getattr(record, key)
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+# Puts records on the queue without ever blocking the logging thread, when the queue is full the record is dropped and counted
+# The message and traceback are rendered here, while the request context is still available, the handlers only format them
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        if has_request_context():
+            record.method = request.method
+            record.path = request.path
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+# Error emails, at most 'limit' every 'interval' seconds and the same error (logged from the same place with the same message) once per interval
+# The next email that goes out reports how many were suppressed in the meantime
+class ThrottledSMTPHandler(SMTPHandler):
+    def __init__(self, *args, interval=300, limit=10, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.interval = interval
+        self.limit = limit
+        self.window = None
+        self.sent = 0
+        self.last_sent = {}
+        self.suppressed = 0
+
+    # Only called from emit(), which the handler's own lock already serializes
+    def allow(self, record):
+        now = monotonic()
+        key = (record.pathname, record.lineno, record.getMessage())
+        if self.window is None or now - self.window >= self.interval:
+            self.window = now
+            self.sent = 0
+            self.last_sent = {key: sent for key, sent in
+                              self.last_sent.items()
+                              if now - sent < self.interval}
+        last = self.last_sent.get(key)
+        if self.sent >= self.limit or \
+                (last is not None and now - last < self.interval):
+            self.suppressed += 1
+            return False
+        self.sent += 1
+        self.last_sent[key] = now
+        return True
+
+    def getSubject(self, record):
+        subject = super().getSubject(record)
+        if self.suppressed:
+            subject += ' ({} similar errors suppressed)'.format(
+                self.suppressed)
+        return subject
+
+    def emit(self, record):
+        if self.allow(record):
+            super().emit(record)
+            self.suppressed = 0
+
+
+# Logging of the application through a queue
+# Request threads only put records on a bounded queue, a QueueListener thread writes them to the log file and sends the error emails,
+# so a slow SMTP server or disk never delays a response
+class LogPipeline:
+    def __init__(self, app=None):
+        self.app = None
+        self.logger = None
+        self.handler = None
+        self.listener = None
+        # Records still queued are written when the process exits
+        atexit.register(self.stop)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # The listener of a previous application is stopped even when this one doesn't log through the pipeline
+        self.stop()
+        self.app = app
+        app.extensions['log_pipeline'] = self
+        if app.debug or app.testing:
+            return
+        self.start(app.logger, self.handlers(app))
+        app.logger.setLevel(logging.INFO)
+        app.logger.info('Microblog startup')
+
+    def handlers(self, app):
+        if app.config['LOG_FORMAT'] == 'json':
+            formatter = JSONFormatter()
+        else:
+            formatter = logging.Formatter(
+                '%(asctime)s %(levelname)s: %(message)s '
+                '[in %(pathname)s:%(lineno)d]')
+        handlers = []
+        if app.config['MAIL_SERVER']:
+            auth = None
+            if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
+                auth = (app.config['MAIL_USERNAME'],
+                        app.config['MAIL_PASSWORD'])
+            secure = None
+            if app.config['MAIL_USE_TLS']:
+                secure = ()
+            mail_handler = ThrottledSMTPHandler(
+                mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+                fromaddr='no-reply@' + app.config['MAIL_SERVER'],
+                toaddrs=app.config['ADMINS'], subject='Microblog Failure',
+                credentials=auth, secure=secure,
+                interval=app.config['LOG_MAIL_INTERVAL'],
+                limit=app.config['LOG_MAIL_LIMIT'])
+            mail_handler.setLevel(logging.ERROR)
+            handlers.append(mail_handler)
+
+        if not os.path.exists('logs'):
+            os.mkdir('logs')
+        file_handler = RotatingFileHandler(
+            'logs/microblog.log', maxBytes=app.config['LOG_MAX_BYTES'],
+            backupCount=app.config['LOG_BACKUP_COUNT'])
+        file_handler.setFormatter(formatter)
+        file_handler.setLevel(logging.INFO)
+        handlers.append(file_handler)
+        return handlers
+
+    def start(self, logger, handlers):
+        self.stop()
+        self.handler = NonBlockingQueueHandler(
+            Queue(maxsize=self.app.config['LOG_QUEUE_SIZE']))
+        logger.addHandler(self.handler)
+        self.logger = logger
+        self.listener = QueueListener(self.handler.queue, *handlers,
+                                      respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.logger.removeHandler(self.handler)
+            self.listener.stop()
+            self.listener = None
+
+    def stats(self):
+        if self.handler is None:
+            return {'depth': 0, 'dropped': 0}
+        return {'depth': self.handler.queue.qsize(),
+                'dropped': self.handler.dropped}
+
+
+log_pipeline = LogPipeline()
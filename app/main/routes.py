@@ -1,84 +1,211 @@
+import re
 from datetime import datetime, timezone
 from urllib.parse import urlsplit
-from flask import render_template, flash, redirect, url_for, request, g, current_app
+from flask import render_template, flash, redirect, url_for, request, g, \
+    current_app, abort, stream_with_context
 from flask_login import login_user, logout_user, current_user, login_required
 from flask_babel import _, get_locale
+from werkzeug.exceptions import ServiceUnavailable
 import sqlalchemy as sa
+import sqlalchemy.orm as so
 from app import db
 from app.main import bp
 from app.auth.forms import LoginForm, RegistrationForm, ResetPasswordRequestForm, ResetPasswordForm
-from app.main.forms import EditProfileForm, EmptyForm, PostForm
-from app.models import User, Post
+from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm
+from app.models import User, Post, search_rank, suggestion
 from app.auth.email import send_password_reset_email
-from langdetect import detect, LangDetectException
-from app.translate import translate
+from app.translate import translate, translate_batch
+from app.pagination import keyset_paginate
+from app.last_seen import tracker as last_seen
+from app.language import detector as language_detector
+from app.fragments import fragment_cache
+from app.user_cache import cache as user_cache
+from app.replicas import read_replica, stick_to_primary
+from app.conditional import PageValidators, latest
+from app.bulk import jsonl_lines, csv_lines
+from app.stream import post_stream
+from app.ratelimit import limiter
 
 @bp.before_request
 def before_request():
+    # Recent visits are coalesced and written in batches instead of committing on every request
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        last_seen.touch(current_user._get_current_object())
+        g.search_form = SearchForm()
     g.locale = str(get_locale())
 
 
+# Id and timestamp of the newest post matching the criteria, and the time of the last change to any user (see User.updated), three index lookups
+def newest_post(*criteria):
+    return db.session.execute(
+        sa.select(sa.func.max(Post.id), sa.func.max(Post.timestamp),
+                  sa.select(sa.func.max(User.updated)).scalar_subquery())
+        .where(*criteria)).one()
+
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
+@read_replica
+@limiter.limit('RATELIMIT_POST')
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ''
-        post = Post(body=form.post.data, author=current_user, language=language)
+        # The language is detected in the background, the post is saved with it pending
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
+        post.publish()
         db.session.commit()
+        stick_to_primary()
+        language_detector.submit(post)
+        post_stream.post_created(post)
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
     
-    page = request.args.get('page', 1, type=int)
-    posts = db.paginate(current_user.following_posts(), page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.index', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
-        if posts.has_prev else None
-    return render_template('index.html', title=_('Home'), form=form, posts=posts.items, next_url=next_url, prev_url=prev_url)
+    # Any new post can change the home feed, and so can a change to any user: a follow by the user, or by a followed account (the suggestions),
+    # a renamed author or a detected language
+    newest_id, newest_timestamp, updated = newest_post()
+    suggested = db.session.execute(
+        sa.select(sa.func.count(), sa.func.sum(suggestion.c.score))
+        .where(suggestion.c.user_id == current_user.id)).one()
+    validators = PageValidators(
+        newest_id, updated, current_user.following_count(), *suggested,
+        last_modified=latest(newest_timestamp, updated))
+    if validators.not_modified():
+        return validators.not_modified_response()
+    suggestions = db.session.execute(current_user.suggestions().limit(
+        current_app.config['SUGGESTIONS_SHOWN'])).all()
+    # Authors are loaded in bulk with one extra SELECT, otherwise _post.html would lazy load them one post at a time
+    query = current_user.home_posts().options(so.selectinload(Post.author))
+    posts = keyset_paginate(query, (Post.timestamp, Post.id),
+                            current_app.config['POSTS_PER_PAGE'])
+    next_url = posts.next_url('main.index')
+    prev_url = posts.prev_url('main.index')
+    return validators.apply(render_template('index.html', title=_('Home'), form=form, posts=posts.items, suggestions=suggestions, next_url=next_url, prev_url=prev_url))
+
+
+# New posts of the users the current user follows as server-sent events, the home page offers to reload when one arrives
+# The events are generated without the request's application context, the database session is released before the stream starts
+# Browsers don't reconnect after a 204 or a 503, which answer when the stream is disabled or the process has no connection to spare
+@bp.route('/stream')
+@login_required
+def stream():
+    if not current_app.config['STREAM_ENABLED']:
+        return '', 204
+    subscriber = post_stream.subscribe(current_user.id)
+    if subscriber is None:
+        # By then the connections open now have been recycled
+        raise ServiceUnavailable(
+            retry_after=current_app.config['STREAM_MAX_AGE'])
+    response = current_app.response_class(
+        post_stream.events(subscriber), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # The events never start for a HEAD request or a client gone before the first one
+    response.call_on_close(lambda: post_stream.unsubscribe(subscriber))
+    return response
 
 
 @bp.route('/explore')
 @login_required
+@read_replica
 def explore():
-    page = request.args.get('page', 1, type=int)
-    query = sa.select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
-        if posts.has_prev else None
-    return render_template('index.html', title=_('Explore'),
-                           posts=posts.items, next_url=next_url,
-                           prev_url=prev_url)
+    newest_id, newest_timestamp, updated = newest_post()
+    validators = PageValidators(newest_id, updated, last_modified=latest(
+        newest_timestamp, updated))
+    if validators.not_modified():
+        return validators.not_modified_response()
+    query = sa.select(Post).options(so.selectinload(Post.author))
+    posts = keyset_paginate(query, (Post.timestamp, Post.id),
+                            current_app.config['POSTS_PER_PAGE'])
+    next_url = posts.next_url('main.explore')
+    prev_url = posts.prev_url('main.explore')
+    return validators.apply(render_template(
+        'index.html', title=_('Explore'), posts=posts.items,
+        next_url=next_url, prev_url=prev_url))
 
 
 @bp.route('/user/<username>')
 @login_required
+@read_replica
 def user(username):
     user = db.first_or_404(sa.select(User).where(User.username == username))
-    page = request.args.get('page', 1, type=int)
-    query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('main.user', username=user.username, page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.user', username=user.username, page=posts.prev_num) \
-        if posts.has_prev else None
+    # Only the user's own changes show on the page, following them stamps them too
+    newest_id, newest_timestamp, _ = newest_post(Post.user_id == user.id)
+    validators = PageValidators(
+        newest_id, user.id, user.username, user.about_me, user.last_seen,
+        user.updated, user.followers_count(), user.following_count(),
+        current_user.is_following(user),
+        last_modified=latest(newest_timestamp, user.last_seen, user.updated))
+    if validators.not_modified():
+        return validators.not_modified_response()
+    query = user.posts.select().options(so.selectinload(Post.author))
+    posts = keyset_paginate(query, (Post.timestamp, Post.id),
+                            current_app.config['POSTS_PER_PAGE'])
+    next_url = posts.next_url('main.user', username=user.username)
+    prev_url = posts.prev_url('main.user', username=user.username)
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items,
-                           next_url=next_url, prev_url=prev_url, form=form)
+    return validators.apply(render_template(
+        'user.html', user=user, posts=posts.items, next_url=next_url,
+        prev_url=prev_url, form=form))
+
+
+# Full post history of a user, oldest first, as JSON Lines or CSV
+# Rows are read through a streaming cursor and written out as they arrive, so memory use is the same for any number of posts
+# An interrupted download is resumed from the id of the last post received, with ?since_id=N or a 'Range: id=N-' header
+# A Range request is answered with 206 and a 'Content-Range: id N-M/*' header, M being the newest post id of the user when the download started
+@bp.route('/user/<username>/posts.<any(jsonl, csv):format>')
+@login_required
+@read_replica
+def export_posts(username, format):
+    user = db.first_or_404(sa.select(User).where(User.username == username))
+    since_id = request.args.get('since_id', type=int)
+    range_match = re.fullmatch(r'id=(\d+)-', request.headers.get('Range', ''))
+    if range_match:
+        since_id = int(range_match.group(1))
+    columns = (Post.id, Post.body, Post.timestamp, Post.language)
+    query = user.posts.select().with_only_columns(*columns).order_by(Post.id)
+    if since_id is not None:
+        query = query.where(Post.id > since_id)
+    result = db.session.execute(query, execution_options={
+        'yield_per': current_app.config['EXPORT_CHUNK_SIZE']})
+    rows = (dict(row) for row in result.mappings())
+    if format == 'csv':
+        lines = csv_lines(rows, [column.key for column in columns])
+        mimetype = 'text/csv'
+    else:
+        lines = jsonl_lines(rows)
+        mimetype = 'application/x-ndjson'
+    response = current_app.response_class(
+        stream_with_context(lines), mimetype=mimetype)
+    response.headers['Content-Disposition'] = \
+        'attachment; filename={}-posts.{}'.format(user.username, format)
+    response.headers['Accept-Ranges'] = 'id'
+    if range_match:
+        newest_id = db.session.scalar(sa.select(sa.func.max(Post.id)).where(
+            Post.user_id == user.id))
+        response.status_code = 206
+        response.headers['Content-Range'] = 'id {}-{}/*'.format(
+            since_id, max(newest_id or 0, since_id))
+    return response
+
+
+@bp.route('/search')
+@login_required
+@read_replica
+def search():
+    if not g.search_form.validate():
+        return redirect(url_for('main.explore'))
+    q = g.search_form.q.data
+    # Best matches first, paged on the (rank, id) of the last result
+    query = Post.search(q).options(so.selectinload(Post.author))
+    posts = keyset_paginate(query, (search_rank, Post.id),
+                            current_app.config['POSTS_PER_PAGE'],
+                            descending=False)
+    next_url = posts.next_url('main.search', q=q)
+    prev_url = posts.prev_url('main.search', q=q)
+    return render_template('search.html', title=_('Search'),
+                           posts=posts.items, next_url=next_url,
+                           prev_url=prev_url)
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -86,9 +213,14 @@ def user(username):
 def edit_profile():
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
+        if form.username.data != current_user.username:
+            fragment_cache.invalidate_author(current_user.id)
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
+        current_user.updated = datetime.now(timezone.utc)
         db.session.commit()
+        user_cache.invalidate(current_user.id)
+        stick_to_primary()
         flash(_('Your changes have been saved.'))
         return redirect(url_for('main.edit_profile'))
     elif request.method == 'GET':
@@ -113,6 +245,7 @@ def follow(username):
             return redirect(url_for('main.user', username=username))
         current_user.follow(user)
         db.session.commit()
+        stick_to_primary()
         flash(_('You are following %(username)s!', username=username))
         return redirect(url_for('main.user', username=username))
     else:
@@ -134,6 +267,7 @@ def unfollow(username):
             return redirect(url_for('main.user', username=username))
         current_user.unfollow(user)
         db.session.commit()
+        stick_to_primary()
         flash(_('You are not following %(username)s.', username=username))
         return redirect(url_for('main.user', username=username))
     else:
@@ -142,12 +276,30 @@ def unfollow(username):
 # Returns data instead of HTML/redirect 
 @bp.route('/translate', methods=['POST'])
 @login_required
+@limiter.limit('RATELIMIT_TRANSLATE')
 def translate_text():
     # request.get_json() method returns a dictionary with data that the client has submitted in JSON format
     data = request.get_json()
+    # Batch form: {'dest_language': ..., 'items': [{'text': ..., 'source_language': ...}, ...]}
+    # Every post waiting for a translation on the page is sent at once, texts sharing a source language go to the service in one call
+    if 'items' in data:
+        items = data['items']
+        if len(items) > current_app.config['MS_TRANSLATOR_BATCH_SIZE']:
+            abort(400)
+        by_language = {}
+        for i, item in enumerate(items):
+            by_language.setdefault(item['source_language'], []).append(i)
+        texts = [None] * len(items)
+        for source_language, positions in by_language.items():
+            translations = translate_batch(
+                [items[i]['text'] for i in positions], source_language,
+                data['dest_language'])
+            for i, translation in zip(positions, translations):
+                texts[i] = translation
+        return {'texts': texts}
     # Invokes thew the translate function from translate.py, passing the three arguments directly from the JSON data that was submitted with the request
     # The result is incorporated into a dictionary with a single key called text, which is returned as the response
     # Flask automatically dictionaries returned by view functions to the JSON format
     return {'text': translate(data['text'],
                               data['source_language'],
-                              data['dest_language'])}
\ No newline at end of file
+                              data['dest_language'])}
@@ -1,7 +1,8 @@
 from app import login, db
+from app.user_cache import cache as user_cache
+from app.passwords import hasher as password_hasher
 from flask import current_app
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from typing import Optional
 import sqlalchemy as sa # General purpose database functions and classes such as types and query building helpers
 import sqlalchemy.orm as so # Support for using models
@@ -9,6 +10,8 @@ from flask_login import UserMixin
 from hashlib import md5
 from time import time
 import jwt
+import secrets
+import re
 
 followers = sa.Table(
     'followers',
@@ -16,9 +19,94 @@ followers = sa.Table(
     sa.Column('follower_id', sa.Integer, sa.ForeignKey('user.id'),
               primary_key=True),
     sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id'),
+              primary_key=True),
+    # Fan-out on write looks up everyone following an author
+    sa.Index('ix_followers_followed_id', 'followed_id')
+)
+
+# Materialized home timeline (one inbox row per post delivered to a user)
+# Only used when TIMELINE_ENABLED is set, see User.home_posts()
+timeline = sa.Table(
+    'timeline',
+    db.metadata,
+    sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'),
+              primary_key=True),
+    sa.Column('post_id', sa.Integer, sa.ForeignKey('post.id'),
               primary_key=True)
 )
 
+# Who to follow: accounts followed by the accounts a user follows, 'score' is how many of them follow it
+# Rebuilt in batches by 'flask suggestions rebuild' and kept up to date by follow()/unfollow() in between
+# Only the best SUGGESTIONS_PER_USER of each user are stored: when an unfollow lowers a stored score, an account cut earlier can't take
+# its place until it gains a follower the user follows or the next rebuild, so the ranking is approximate between rebuilds
+suggestion = sa.Table(
+    'suggestion',
+    db.metadata,
+    sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'),
+              primary_key=True),
+    sa.Column('suggested_id', sa.Integer, sa.ForeignKey('user.id'),
+              primary_key=True),
+    sa.Column('score', sa.Integer, nullable=False),
+    # A user's best suggestions are read first
+    sa.Index('ix_suggestion_user_id_score', 'user_id', 'score')
+)
+
+# Adds 'delta' to the score of the (user id, suggested id) pairs selected by 'pairs', with the follow already flushed
+# Missing pairs are inserted when the delta is positive, pairs left with no score are deleted when it is negative
+# A missing pair may have been cut by the last trim, so it is inserted with its full score, counted the same way as the rebuild does
+def adjust_suggestions(pairs, delta):
+    pairs = pairs.subquery()
+    selected = suggestion.c.user_id == pairs.c.user_id, \
+        suggestion.c.suggested_id == pairs.c.suggested_id
+    db.session.execute(suggestion.update().where(
+        sa.select(pairs).where(*selected).exists())
+        .values(score=suggestion.c.score + delta))
+    if delta > 0:
+        existing = sa.select(suggestion).where(*selected)
+        followed = followers.alias('followed')
+        vouching = followers.alias('vouching')
+        score = (
+            sa.select(sa.func.count())
+            .select_from(followed)
+            .join(vouching, vouching.c.follower_id == followed.c.followed_id)
+            .join(User, User.id == followed.c.followed_id)
+            .where(followed.c.follower_id == pairs.c.user_id,
+                   vouching.c.followed_id == pairs.c.suggested_id,
+                   User.num_following <=
+                   current_app.config['SUGGESTIONS_FANOUT_LIMIT'])
+            .scalar_subquery()
+        )
+        db.session.execute(suggestion.insert().from_select(
+            ['user_id', 'suggested_id', 'score'],
+            sa.select(pairs.c.user_id, pairs.c.suggested_id, score)
+            .where(~existing.exists())))
+        trim_suggestions(sa.select(pairs.c.user_id))
+    else:
+        db.session.execute(suggestion.delete().where(
+            suggestion.c.score <= 0,
+            sa.select(pairs).where(*selected).exists()))
+
+# Keeps the best SUGGESTIONS_PER_USER suggestions of the users selected by 'user_ids', like the rebuild
+def trim_suggestions(user_ids):
+    ranked = sa.select(
+        suggestion.c.user_id, suggestion.c.suggested_id,
+        sa.func.row_number().over(
+            partition_by=suggestion.c.user_id,
+            order_by=(suggestion.c.score.desc(),
+                      suggestion.c.suggested_id)).label('position')
+    ).where(suggestion.c.user_id.in_(user_ids)).subquery()
+    db.session.execute(suggestion.delete().where(
+        sa.select(ranked).where(
+            ranked.c.user_id == suggestion.c.user_id,
+            ranked.c.suggested_id == suggestion.c.suggested_id,
+            ranked.c.position > current_app.config['SUGGESTIONS_PER_USER'])
+        .exists()))
+
+# Gravatar image of an email address, also used by the API, which doesn't load User objects
+def avatar_url(email, size):
+    digest = md5(email.lower().encode('utf-8')).hexdigest()
+    return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+
 # This class inherits from db.Model, a base class for all models from Flask-SQLAlchemy
 # Represent users stored in the database
 class User(UserMixin, db.Model):
@@ -29,6 +117,16 @@ class User(UserMixin, db.Model):
     password_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(256)) # 'Optional' allows for empty or nullable
     about_me: so.Mapped[Optional[str]] = so.mapped_column(sa.String(140))
     last_seen: so.Mapped[Optional[datetime]] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
+    # Denormalized counters, kept in step by follow()/unfollow() and Post.publish(), 'flask counters repair' recomputes them
+    num_followers: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    num_following: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    num_posts: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    # Bearer token of the JSON API, see get_token()
+    token: so.Mapped[Optional[str]] = so.mapped_column(sa.String(32), index=True, unique=True)
+    token_expiration: so.Mapped[Optional[datetime]]
+    # Last change to what the user's pages show, other than a new post: a profile edit, a follow either way, detected languages of their posts
+    # or rebuilt suggestions, conditional GETs compare it instead of running the feed queries
+    updated: so.Mapped[Optional[datetime]] = so.mapped_column(index=True, default=lambda: datetime.now(timezone.utc))
 
     following: so.WriteOnlyMapped['User'] = so.relationship(
         secondary=followers, primaryjoin=(followers.c.follower_id == id),
@@ -45,39 +143,121 @@ class User(UserMixin, db.Model):
     
     # Generates a password hash for the current/'self' user's input password
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     # Compares the current/'self' user's stored password hash with the input password hashed
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
     
     # Generates avatars for unique emails
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        return avatar_url(self.email, size)
     
     # Follower/Following functionality
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            self.adjust_follow_counters(user, 1)
+            self.update_suggestions(user, 1)
+            if current_app.config['TIMELINE_ENABLED'] and \
+                    not user.is_celebrity():
+                # Copy the recent posts of the new followee into the inbox
+                user.push_recent_posts(
+                    sa.select(User.id).where(User.id == self.id))
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self.adjust_follow_counters(user, -1)
+            self.update_suggestions(user, -1)
+            if current_app.config['TIMELINE_ENABLED']:
+                db.session.execute(timeline.delete().where(
+                    timeline.c.user_id == self.id,
+                    timeline.c.post_id.in_(
+                        sa.select(Post.id).where(Post.user_id == user.id))))
+                # Dropping back to the fan-out limit means the followee's posts are no longer pulled at read time, so push them to the remaining followers
+                if user.followers_count() == \
+                        current_app.config['TIMELINE_FANOUT_LIMIT']:
+                    user.push_recent_posts(
+                        sa.select(followers.c.follower_id).where(
+                            followers.c.followed_id == user.id))
 
     def is_following(self, user):
         query = self.following.select().where(User.id == user.id)
         return db.session.scalar(query) is not None
 
+    # The counters are updated in the database with an atomic 'x = x + delta', the ORM synchronizes the loaded objects
+    # Both users' pages change, so both are stamped as updated
+    def adjust_follow_counters(self, user, delta):
+        now = datetime.now(timezone.utc)
+        db.session.execute(sa.update(User).where(User.id == self.id).values(
+            num_following=User.num_following + delta, updated=now))
+        db.session.execute(sa.update(User).where(User.id == user.id).values(
+            num_followers=User.num_followers + delta, updated=now))
+
+    # Incremental upkeep of the suggestions when self starts (delta=1) or stops (delta=-1) following user
+    # Accounts following more than SUGGESTIONS_FANOUT_LIMIT users don't vouch for anyone, same as in the rebuild, and the suggestions of
+    # the followers of an account with more followers than that are left to the next rebuild, so one follow never touches an unbounded number of rows
+    def update_suggestions(self, user, delta):
+        limit = current_app.config['SUGGESTIONS_FANOUT_LIMIT']
+        db.session.flush()
+        followed = sa.select(followers.c.followed_id).where(
+            followers.c.follower_id == self.id)
+        # The accounts user follows, for self
+        if user.following_count() <= limit:
+            adjust_suggestions(
+                sa.select(sa.literal(self.id).label('user_id'),
+                          followers.c.followed_id.label('suggested_id'))
+                .where(followers.c.follower_id == user.id,
+                       followers.c.followed_id != self.id,
+                       followers.c.followed_id.not_in(followed)),
+                delta)
+        # User, for the followers of self
+        if self.following_count() <= limit and \
+                self.followers_count() <= limit:
+            following_user = sa.select(followers.c.follower_id).where(
+                followers.c.followed_id == user.id)
+            adjust_suggestions(
+                sa.select(followers.c.follower_id.label('user_id'),
+                          sa.literal(user.id).label('suggested_id'))
+                .where(followers.c.followed_id == self.id,
+                       followers.c.follower_id != user.id,
+                       followers.c.follower_id.not_in(following_user)),
+                delta)
+        db.session.execute(suggestion.delete().where(
+            suggestion.c.user_id == self.id,
+            suggestion.c.suggested_id == user.id))
+        if delta > 0:
+            return
+        # User can be a suggestion again, vouched for by the accounts self still follows
+        vouching = sa.select(User.id).where(
+            User.id.in_(followed), User.num_following <= limit)
+        db.session.execute(suggestion.insert().from_select(
+            ['user_id', 'suggested_id', 'score'],
+            sa.select(sa.literal(self.id), followers.c.followed_id,
+                      sa.func.count())
+            .where(followers.c.followed_id == user.id,
+                   followers.c.follower_id.in_(vouching))
+            .group_by(followers.c.followed_id)))
+        trim_suggestions(sa.select(sa.literal(self.id)))
+
+    # Suggested accounts, best first, with the number of followed accounts that follow each of them
+    def suggestions(self):
+        return (
+            sa.select(User, suggestion.c.score)
+            .join(suggestion, suggestion.c.suggested_id == User.id)
+            .where(suggestion.c.user_id == self.id)
+            .order_by(suggestion.c.score.desc(), User.id)
+        )
+
     def followers_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.followers.select().subquery())
-        return db.session.scalar(query)
+        return self.num_followers
 
     def following_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.following.select().subquery())
-        return db.session.scalar(query)
+        return self.num_following
+
+    def posts_count(self):
+        return self.num_posts
     
     # Return all the posts of user the users they are following
     def following_posts(self):
@@ -102,6 +282,55 @@ class User(UserMixin, db.Model):
             .order_by(Post.timestamp.desc())
         )
     
+    # Authors with huge follower counts are not fanned out on write, their posts are pulled into followers' timelines at read time instead
+    def is_celebrity(self):
+        return self.followers_count() > \
+            current_app.config['TIMELINE_FANOUT_LIMIT']
+
+    # Home feed, served from the timeline store when it is enabled
+    def home_posts(self):
+        if current_app.config['TIMELINE_ENABLED']:
+            return self.timeline_posts()
+        return self.following_posts()
+
+    # Hybrid push/pull feed: posts delivered to the user's inbox plus posts from followed celebrity accounts
+    def timeline_posts(self):
+        inbox = sa.select(timeline.c.post_id).where(
+            timeline.c.user_id == self.id)
+        followed = sa.select(followers.c.followed_id).where(
+            followers.c.follower_id == self.id)
+        celebrities = sa.select(User.id).where(
+            User.id.in_(followed),
+            User.num_followers > current_app.config['TIMELINE_FANOUT_LIMIT'])
+        return (
+            sa.select(Post)
+            .where(sa.or_(
+                Post.id.in_(inbox),
+                Post.user_id.in_(celebrities),
+            ))
+            .order_by(Post.timestamp.desc())
+        )
+
+    # Delivers this user's most recent posts to the inboxes of the users selected by 'recipients' (a select of user ids)
+    def push_recent_posts(self, recipients):
+        recipients = recipients.subquery()
+        recent = (
+            sa.select(Post.id)
+            .where(Post.user_id == self.id)
+            .order_by(Post.timestamp.desc())
+            .limit(current_app.config['TIMELINE_BACKFILL'])
+            .subquery()
+        )
+        existing = sa.select(timeline.c.post_id).where(
+            timeline.c.user_id == recipients.c[0],
+            timeline.c.post_id == recent.c.id)
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id'],
+            sa.select(recipients.c[0], recent.c.id)
+            .select_from(recipients)
+            .join(recent, sa.true())
+            .where(~existing.exists())))
+
     # Returns a JSON Web Token (JWT) as a string
     # jwt.encode params: payload, secret_key, algorithm
     def get_reset_password_token(self, expires_in=600):
@@ -120,6 +349,30 @@ class User(UserMixin, db.Model):
         except:
             return
         return db.session.get(User, id)
+
+    # Returns a random API token, the current one is reused while it has more than a minute left
+    def get_token(self, expires_in=3600):
+        now = datetime.now(timezone.utc)
+        if self.token and self.token_expiration.replace(
+                tzinfo=timezone.utc) > now + timedelta(seconds=60):
+            return self.token
+        self.token = secrets.token_hex(16)
+        self.token_expiration = now + timedelta(seconds=expires_in)
+        db.session.add(self)
+        return self.token
+
+    def revoke_token(self):
+        self.token_expiration = datetime.now(timezone.utc) - \
+            timedelta(seconds=1)
+
+    # Returns the user a token belongs to, or None when it is unknown or expired
+    @staticmethod
+    def check_token(token):
+        user = db.session.scalar(sa.select(User).where(User.token == token))
+        if user is None or user.token_expiration.replace(
+                tzinfo=timezone.utc) < datetime.now(timezone.utc):
+            return None
+        return user
         
 class Post(db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
@@ -130,12 +383,98 @@ class Post(db.Model):
 
     author: so.Mapped[User] = so.relationship(back_populates='posts') # These two attributes (This and User.posts) allow the application to access the connected user and post entries
 
+    # Called once when a new post is created: bumps the author's post counter and delivers the post to timelines
+    def publish(self):
+        db.session.flush()
+        db.session.execute(sa.update(User).where(User.id == self.user_id).values(
+            num_posts=User.num_posts + 1))
+        self.fan_out()
+
+    # Fan-out on write: delivers a new post to the author's inbox and, unless the author is a celebrity, to every follower's inbox
+    # The post needs an id, so the session is flushed first
+    def fan_out(self):
+        if not current_app.config['TIMELINE_ENABLED']:
+            return
+        db.session.flush()
+        recipients = sa.select(sa.literal(self.user_id).label('user_id'))
+        if not self.author.is_celebrity():
+            recipients = sa.union_all(
+                recipients,
+                sa.select(followers.c.follower_id).where(
+                    followers.c.followed_id == self.user_id))
+        recipients = recipients.subquery()
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id'],
+            sa.select(recipients.c.user_id, sa.literal(self.id))))
+
+    # Full-text search over post bodies, returns the matching posts (rank them with search_rank)
+    # Every word of the user's text is quoted, so FTS5 query syntax in it is matched literally instead of raising errors
+    @staticmethod
+    def search(text):
+        words = re.findall(r'\w+', text)
+        expression = ' '.join('"{}"'.format(word) for word in words)
+        return (
+            sa.select(Post)
+            .join(post_fts, post_fts.c.rowid == Post.id)
+            .where(post_fts.c.post_fts.match(expression) if words
+                   else sa.false())
+        )
+
     # The __repr__ method tells Python how to print objects of this class, which is going to be useful for debugging
     def __repr__(self):
         return '<User {}>'.format(self.username)
 
+# Full-text index of post bodies, an SQLite FTS5 table using the post table as external content
+# Triggers keep it in sync with every insert, update and delete on post, including bulk Core statements
+# 'flask search rebuild' regenerates it from the post table
+post_fts = sa.table('post_fts', sa.column('rowid', sa.Integer),
+                    sa.column('post_fts'))
+# BM25 relevance of a match, lower is better
+search_rank = sa.func.bm25(sa.literal_column('post_fts'), type_=sa.Float)
+
+POST_FTS_DDL = [
+    "CREATE VIRTUAL TABLE post_fts USING fts5("
+    "body, content='post', content_rowid='id')",
+    "CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN "
+    "INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body); END",
+    "CREATE TRIGGER post_fts_delete AFTER DELETE ON post BEGIN "
+    "INSERT INTO post_fts(post_fts, rowid, body) "
+    "VALUES ('delete', old.id, old.body); END",
+    "CREATE TRIGGER post_fts_update AFTER UPDATE OF body ON post BEGIN "
+    "INSERT INTO post_fts(post_fts, rowid, body) "
+    "VALUES ('delete', old.id, old.body); "
+    "INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body); END",
+]
+for statement in POST_FTS_DDL:
+    sa.event.listen(Post.__table__, 'after_create',
+                    sa.DDL(statement).execute_if(dialect='sqlite'))
+sa.event.listen(Post.__table__, 'before_drop',
+                sa.DDL('DROP TABLE IF EXISTS post_fts').execute_if(
+                    dialect='sqlite'))
+
+# Persistent backing store of the translation cache, shared by all worker processes
+class Translation(db.Model):
+    text_hash: so.Mapped[str] = so.mapped_column(sa.String(64), primary_key=True)
+    source_language: so.Mapped[str] = so.mapped_column(sa.String(5), primary_key=True)
+    dest_language: so.Mapped[str] = so.mapped_column(sa.String(5), primary_key=True)
+    text: so.Mapped[str] = so.mapped_column(sa.Text)
+    timestamp: so.Mapped[datetime] = so.mapped_column(index=True, default=lambda: datetime.now(timezone.utc))
+
+# Columns of the session user kept by the user cache
+CACHED_USER_COLUMNS = ('id', 'username', 'email', 'about_me', 'last_seen')
+
 # This decorator registers the function as the callback that Flask-Login will use to retrieve the user object based on the user ID stored in the session
 # Automatically loads the user object from the database based on the user ID stored in the session
+# Cached users are attached to the session without a query, the columns that aren't cached (password hash, counters) are loaded if they are used
 @login.user_loader
 def load_user(id):
-    return db.session.get(User, int(id))
\ No newline at end of file
+    values = user_cache.get(int(id))
+    if values is None:
+        user = db.session.get(User, int(id))
+        if user is not None:
+            user_cache.set(user.id, {key: getattr(user, key)
+                                     for key in CACHED_USER_COLUMNS})
+        return user
+    user = User(**values)
+    so.make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
\ No newline at end of file
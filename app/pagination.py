@@ -0,0 +1,125 @@
+import base64
+import json
+from datetime import datetime
+import sqlalchemy as sa
+from flask import request, url_for
+from app import db
+
+# Keyset (cursor) pagination
+# Instead of OFFSET/LIMIT plus a COUNT(*), each page is fetched with a WHERE on the sort keys of the last row seen, so every page costs the same at any depth
+# One extra row is fetched to find out if there is a further page
+
+
+# Cursors are the sort key values of a row, serialised to an opaque URL-safe string
+def encode_cursor(values):
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+# Returns None for a cursor that can't be decoded, which sends the client back to the first page
+def decode_cursor(cursor, keys):
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(cursor + padding))
+        if not isinstance(values, list) or len(values) != len(keys):
+            return None
+        return [datetime.fromisoformat(v)
+                if isinstance(key.type, sa.DateTime) else v
+                for key, v in zip(keys, values)]
+    except (ValueError, TypeError):
+        return None
+
+
+class KeysetPage:
+    def __init__(self, items, next_args=None, prev_args=None):
+        self.items = items
+        self.next_args = next_args
+        self.prev_args = prev_args
+
+    @property
+    def has_next(self):
+        return self.next_args is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_args is not None
+
+    def next_url(self, endpoint, **values):
+        if self.next_args is None:
+            return None
+        return url_for(endpoint, **values, **self.next_args)
+
+    def prev_url(self, endpoint, **values):
+        if self.prev_args is None:
+            return None
+        return url_for(endpoint, **values, **self.prev_args)
+
+
+# Paginates 'query' on the columns in 'keys', which must be unique together
+# The items of the page are the selected entity when the query selects one (such as select(Post)), or row tuples of the selected columns otherwise
+# The page is taken from the 'after'/'before' cursors in the query string, old '?page=N' links are still served through a COUNT-free OFFSET query
+def keyset_paginate(query, keys, per_page, descending=True):
+    after = request.args.get('after')
+    before = request.args.get('before')
+    page = request.args.get('page', type=int)
+    width = len(query.column_descriptions)
+    query = query.order_by(None).add_columns(*keys)
+
+    def ordered(reverse=False):
+        if descending != reverse:
+            return query.order_by(*[key.desc() for key in keys])
+        return query.order_by(*keys)
+
+    def fetch(stmt):
+        rows = db.session.execute(stmt.limit(per_page + 1)).all()
+        return rows[:per_page], len(rows) > per_page
+
+    def items(rows):
+        if width == 1:
+            return [row[0] for row in rows]
+        return [row[:width] for row in rows]
+
+    def cursor(row):
+        return encode_cursor(row[width:])
+
+    # Older rows, following the order of the feed
+    if after is not None:
+        values = decode_cursor(after, keys)
+        if values is not None:
+            position = sa.tuple_(*keys) < sa.tuple_(*values) if descending \
+                else sa.tuple_(*keys) > sa.tuple_(*values)
+            rows, more = fetch(ordered().where(position))
+            if rows:
+                return KeysetPage(
+                    items(rows),
+                    next_args={'after': cursor(rows[-1])} if more else None,
+                    prev_args={'before': cursor(rows[0])})
+
+    # Newer rows, fetched in reverse order and flipped back
+    elif before is not None:
+        values = decode_cursor(before, keys)
+        if values is not None:
+            position = sa.tuple_(*keys) > sa.tuple_(*values) if descending \
+                else sa.tuple_(*keys) < sa.tuple_(*values)
+            rows, more = fetch(ordered(reverse=True).where(position))
+            rows.reverse()
+            if rows:
+                return KeysetPage(
+                    items(rows),
+                    next_args={'after': cursor(rows[-1])},
+                    prev_args={'before': cursor(rows[0])} if more else None)
+
+    # Compatibility path for '?page=N' links, the following pages switch to cursors
+    elif page is not None and page > 1:
+        rows, more = fetch(ordered().offset((page - 1) * per_page))
+        if rows:
+            return KeysetPage(
+                items(rows),
+                next_args={'after': cursor(rows[-1])} if more else None,
+                prev_args={'page': page - 1})
+
+    rows, more = fetch(ordered())
+    return KeysetPage(
+        items(rows),
+        next_args={'after': cursor(rows[-1])} if more else None)
@@ -0,0 +1,134 @@
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+import sqlalchemy as sa
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+from app import db
+
+
+# Password hashing and verification with the method and cost set in PASSWORD_HASH_METHOD (a Werkzeug method string such as 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000')
+# The work runs on a pool of PASSWORD_HASH_WORKERS threads (hashlib releases the GIL while hashing), so a burst of logins uses at most that many cores
+# and page rendering keeps the rest, at most PASSWORD_HASH_QUEUE_SIZE more requests wait for a thread, and the others get a 503 after PASSWORD_HASH_TIMEOUT seconds
+# With 0 workers everything is hashed inline
+class PasswordHasher:
+    def __init__(self, app=None):
+        self.app = None
+        self.pool = None
+        self.slots = None
+        self.lock = Lock()
+        self.methods = {}
+        # Queued rehashes are finished and the threads stopped when the process exits
+        atexit.register(self.shutdown)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # The threads of a previous application are stopped, the pool of this one is started on first use
+        self.shutdown()
+        self.app = app
+        app.extensions['password_hasher'] = self
+        self.slots = BoundedSemaphore(
+            app.config['PASSWORD_HASH_WORKERS'] +
+            app.config['PASSWORD_HASH_QUEUE_SIZE'])
+        self.rehashed = 0
+        self.rejected = 0
+
+    # None when hashing runs inline
+    def executor(self):
+        workers = self.app.config['PASSWORD_HASH_WORKERS']
+        if not workers:
+            return None
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(workers, 'password-hash')
+            return self.pool
+
+    def shutdown(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def run(self, function, *args, timeout=None):
+        pool = self.executor()
+        if pool is None:
+            return function(*args)
+        if timeout is None:
+            timeout = self.app.config['PASSWORD_HASH_TIMEOUT']
+        if not self.slots.acquire(timeout=timeout):
+            with self.lock:
+                self.rejected += 1
+            raise ServiceUnavailable(retry_after=1)
+        future = pool.submit(function, *args)
+        future.add_done_callback(lambda future: self.slots.release())
+        return future.result()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password,
+                        self.app.config['PASSWORD_HASH_METHOD'],
+                        self.app.config['PASSWORD_SALT_LENGTH'])
+
+    def verify(self, pwhash, password):
+        return self.run(check_password_hash, pwhash, password)
+
+    # Full method string of the configured setting, Werkzeug fills in the default parameters of a bare method name
+    def method(self):
+        method = self.app.config['PASSWORD_HASH_METHOD']
+        with self.lock:
+            if method not in self.methods:
+                self.methods[method] = generate_password_hash(
+                    '', method, 1).split('$')[0]
+            return self.methods[method]
+
+    def needs_rehash(self, pwhash):
+        method, salt, digest = pwhash.split('$', 2)
+        return method != self.method() or \
+            len(salt) != self.app.config['PASSWORD_SALT_LENGTH']
+
+    # Stores a new hash of a verified password in the background
+    # The UPDATE only applies while the old hash is still stored, so it can't overwrite a password changed in the meantime, and is skipped when the pool is busy
+    def rehash(self, user_id, pwhash, password):
+        pool = self.executor()
+        if pool is None:
+            return self.store_rehash(user_id, pwhash, password)
+        if not self.slots.acquire(blocking=False):
+            return None
+        future = pool.submit(self.store_rehash, user_id, pwhash, password)
+        future.add_done_callback(lambda future: self.slots.release())
+        return future
+
+    def store_rehash(self, user_id, pwhash, password):
+        new_hash = generate_password_hash(
+            password, self.app.config['PASSWORD_HASH_METHOD'],
+            self.app.config['PASSWORD_SALT_LENGTH'])
+        table = db.metadata.tables['user']
+        with self.app.app_context(), db.engine.begin() as connection:
+            result = connection.execute(
+                sa.update(table)
+                .where(table.c.id == user_id, table.c.password_hash == pwhash)
+                .values(password_hash=new_hash))
+        if result.rowcount:
+            with self.lock:
+                self.rehashed += 1
+        return result.rowcount == 1
+
+    # Waits until no hashing is queued or running
+    def join(self):
+        if not self.app.config['PASSWORD_HASH_WORKERS']:
+            return
+        size = self.app.config['PASSWORD_HASH_WORKERS'] + \
+            self.app.config['PASSWORD_HASH_QUEUE_SIZE']
+        for i in range(size):
+            self.slots.acquire()
+        for i in range(size):
+            self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {'method': self.app.config['PASSWORD_HASH_METHOD'],
+                    'workers': self.app.config['PASSWORD_HASH_WORKERS'],
+                    'rehashed': self.rehashed, 'rejected': self.rejected}
+
+
+hasher = PasswordHasher()
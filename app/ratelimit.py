@@ -0,0 +1,195 @@
+from collections import OrderedDict
+from functools import lru_cache, wraps
+import json
+from math import ceil
+import sqlite3
+from threading import Lock, local
+from time import time
+from flask import request
+from flask_login import current_user
+from sqlalchemy.engine import make_url
+from werkzeug.exceptions import TooManyRequests
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+# '10/minute' -> (10, 60)
+@lru_cache(maxsize=None)
+def parse_rate(rate):
+    limit, _, period = rate.partition('/')
+    return int(limit), PERIODS[period.strip().rstrip('s')]
+
+
+# The algorithms take the stored state of a key (None for a new key) and return its new state, with the seconds
+# to wait before trying again when the request is over the limit (0 when it is allowed)
+
+# Allows bursts of up to 'limit' requests, refilled at 'limit' per 'period', state is (tokens, time of the last request)
+def token_bucket(state, now, limit, period):
+    tokens, updated = state or (limit, now)
+    tokens = min(limit, tokens + (now - updated) * limit / period)
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) * period / limit
+
+
+# At most 'limit' requests in any 'period', the count of the previous fixed window is weighted by how much of it
+# the sliding window still covers, state is (start of the current window, previous count, current count)
+def sliding_window(state, now, limit, period):
+    start = now - now % period
+    window, previous, current = state or (start, 0, 0)
+    if window != start:
+        previous = current if window == start - period else 0
+        current = 0
+    elapsed = now - start
+    if previous * (1 - elapsed / period) + current + 1 <= limit:
+        return (start, previous, current + 1), 0
+    if current + 1 > limit:
+        return (start, previous, current), period - elapsed
+    return (start, previous, current), \
+        (1 - (limit - current - 1) / previous) * period - elapsed
+
+
+ALGORITHMS = {'token_bucket': token_bucket, 'sliding_window': sliding_window}
+
+
+# Limits of this process only, the least recently used keys are dropped past RATELIMIT_STORAGE_SIZE
+class MemoryStorage:
+    def __init__(self, size):
+        self.size = size
+        self.lock = Lock()
+        self.entries = OrderedDict()
+
+    def hit(self, key, algorithm, now, limit, period):
+        with self.lock:
+            entry = self.entries.get(key)
+            state = entry[1] if entry is not None and entry[0] > now else None
+            state, retry_after = algorithm(state, now, limit, period)
+            # Both algorithms are back to their initial state two periods after the last request
+            self.entries[key] = (now + 2 * period, state)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return retry_after
+
+
+# Limits shared by every process of the host through a SQLite file, separate from the application database
+# Each hit is one short write transaction, BEGIN IMMEDIATE takes the write lock up front so two processes can't both read the old state
+class SQLiteStorage:
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self.local = local()
+        self.lock = Lock()
+        self.writes = 0
+
+    # One connection per thread
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS rate_limit ('
+                'key TEXT PRIMARY KEY, expires REAL NOT NULL, state TEXT)')
+            self.local.connection = connection
+        return connection
+
+    def hit(self, key, algorithm, now, limit, period):
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT state FROM rate_limit WHERE key = ? AND expires > ?',
+                (key, now)).fetchone()
+            state, retry_after = algorithm(
+                tuple(json.loads(row[0])) if row else None, now, limit, period)
+            connection.execute(
+                'INSERT OR REPLACE INTO rate_limit (key, expires, state) '
+                'VALUES (?, ?, ?)', (key, now + 2 * period, json.dumps(state)))
+            with self.lock:
+                self.writes += 1
+                prune = self.writes % self.PRUNE_EVERY == 0
+            if prune:
+                connection.execute('DELETE FROM rate_limit WHERE expires <= ?',
+                                   (now,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return retry_after
+
+
+# Per-route rate limits, declared with the @limiter.limit() decorator
+# Requests are counted per user, or per address for anonymous requests and routes limited 'by' ip, the limit of a route is the
+# RATELIMIT_* configuration key named in its decorator, and a request over it gets a 429 response with a Retry-After header
+# The storage is in memory unless RATELIMIT_STORAGE_URL names a SQLite file, if that storage fails the request is let through
+class RateLimiter:
+    def __init__(self, app=None):
+        self.app = None
+        self.storage = None
+        self.lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['rate_limiter'] = self
+        url = app.config['RATELIMIT_STORAGE_URL']
+        if url:
+            self.storage = SQLiteStorage(
+                make_url(url).database, app.config['RATELIMIT_STORAGE_TIMEOUT'])
+        else:
+            self.storage = MemoryStorage(app.config['RATELIMIT_STORAGE_SIZE'])
+        self.checked = 0
+        self.limited = 0
+        self.failed = 0
+
+    def limit(self, rate, by='user', methods=('POST',),
+              algorithm='token_bucket'):
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if request.method in methods and \
+                        self.app.config['RATELIMIT_ENABLED']:
+                    self.check(rate, by, ALGORITHMS[algorithm])
+                return f(*args, **kwargs)
+            return decorated_function
+        return decorator
+
+    def check(self, rate, by, algorithm):
+        limit, period = parse_rate(self.app.config[rate])
+        # The algorithm is part of the key, the shared storage can outlive a change of the algorithm of a route
+        prefix = '{}:{}'.format(request.endpoint, algorithm.__name__)
+        if by == 'user' and current_user.is_authenticated:
+            key = '{}:user:{}'.format(prefix, current_user.id)
+        else:
+            key = '{}:ip:{}'.format(prefix, request.remote_addr)
+        try:
+            retry_after = self.storage.hit(key, algorithm, time(), limit,
+                                           period)
+        except sqlite3.Error:
+            with self.lock:
+                self.failed += 1
+            self.app.logger.exception('Rate limit storage failed')
+            return
+        with self.lock:
+            self.checked += 1
+            if retry_after:
+                self.limited += 1
+        if retry_after:
+            raise TooManyRequests(retry_after=ceil(retry_after))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'checked': self.checked,
+                'limited': self.limited,
+                'failed': self.failed,
+            }
+
+
+limiter = RateLimiter()
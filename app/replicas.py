@@ -0,0 +1,53 @@
+import random
+from functools import wraps
+from time import time
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+
+# Bind keys of the read replica engines are 'replica0', 'replica1'... in SQLALCHEMY_BINDS
+PREFIX = 'replica'
+
+
+def is_replica(bind_key):
+    return bind_key is not None and bind_key.startswith(PREFIX)
+
+
+# One bind per URL in DATABASE_REPLICA_URLS, added to any binds already configured
+def binds(config):
+    binds = dict(config.get('SQLALCHEMY_BINDS') or {})
+    for i, url in enumerate(config['DATABASE_REPLICA_URLS']):
+        binds['{}{}'.format(PREFIX, i)] = url
+    return binds
+
+
+# Session that sends the SELECTs of views marked with @read_replica to a randomly picked replica
+# Flushes and INSERT/UPDATE/DELETE statements always go to the primary, and so does everything outside those views
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and \
+                getattr(clause, 'is_select', False) and \
+                has_request_context() and g.get('read_replica'):
+            replicas = [engine for key, engine in self._db.engines.items()
+                        if is_replica(key)]
+            if replicas:
+                return random.choice(replicas)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+
+# Called after a user changes something, their reads stay on the primary for REPLICA_STICKY_SECONDS so they see their own writes
+# The deadline is kept in the session cookie, so it holds whichever process serves the next requests
+def stick_to_primary():
+    session['primary_until'] = time() + \
+        current_app.config['REPLICA_STICKY_SECONDS']
+
+
+# Marks a read-only view (GET requests) whose queries can be served by a replica
+def read_replica(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method in ('GET', 'HEAD') and \
+                session.get('primary_until', 0) < time():
+            g.read_replica = True
+        return f(*args, **kwargs)
+    return decorated_function
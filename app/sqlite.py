@@ -0,0 +1,40 @@
+import sqlalchemy as sa
+from app import db
+
+
+def is_file_database(uri):
+    url = sa.engine.make_url(uri)
+    return url.get_backend_name() == 'sqlite' and \
+        url.database not in (None, '', ':memory:')
+
+
+# Production SQLite profile (SQLITE_PRODUCTION)
+# A file database gets a connection pool sized for the worker threads of a process, Flask-SQLAlchemy only reads these options when it creates the engines,
+# so they are worked out before db.init_app()
+def engine_options(config):
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    if config['SQLITE_PRODUCTION'] and \
+            is_file_database(config['SQLALCHEMY_DATABASE_URI']):
+        options.setdefault('pool_size', config['DATABASE_POOL_SIZE'])
+        options.setdefault('max_overflow', config['DATABASE_MAX_OVERFLOW'])
+        options.setdefault('pool_timeout', config['DATABASE_POOL_TIMEOUT'])
+    return options
+
+
+# Every new connection to an SQLite engine runs the SQLITE_PRAGMAS, WAL journal mode lets readers carry on while a write is in progress
+def init_app(app):
+    if not app.config['SQLITE_PRODUCTION']:
+        return
+    pragmas = ['PRAGMA {}={}'.format(name, value)
+               for name, value in app.config['SQLITE_PRAGMAS'].items()]
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                sa.event.listen(engine, 'connect', set_pragmas)
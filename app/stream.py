@@ -0,0 +1,156 @@
+import json
+from queue import Queue, Empty, Full
+from threading import Lock, Thread
+from time import monotonic, sleep
+import sqlalchemy as sa
+from app import db
+from app.models import User, Post, followers
+
+
+# One open /stream connection, notifications wait in a bounded queue until the response sends them
+# A client that falls behind loses the notifications that don't fit instead of growing the queue
+class Subscriber:
+    def __init__(self, user_id, size):
+        self.user_id = user_id
+        self.queue = Queue(maxsize=size)
+        self.dropped = 0
+
+
+# Publish/subscribe of new post notifications, users with an open /stream hear about the posts of the users they follow
+# With STREAM_BROKER = 'memory' the view that saves a post publishes it, which only reaches the connections held by the same process
+# With STREAM_BROKER = 'database' a background thread of each process polls the post table for new rows instead, so posts written by any process are seen
+class PostStream:
+    def __init__(self, app=None):
+        self.app = None
+        self.subscribers = {}
+        self.lock = Lock()
+        self.poller = None
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.rejected = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['post_stream'] = self
+        self.subscribers = {}
+        self.poller = None
+
+    # None when the process already holds STREAM_MAX_CONNECTIONS connections
+    def subscribe(self, user_id):
+        subscriber = Subscriber(user_id, self.app.config['STREAM_QUEUE_SIZE'])
+        with self.lock:
+            if self.connections() >= self.app.config['STREAM_MAX_CONNECTIONS']:
+                self.rejected += 1
+                return None
+            self.subscribers.setdefault(user_id, set()).add(subscriber)
+        if self.app.config['STREAM_BROKER'] == 'database':
+            self.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(subscriber.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.subscribers[subscriber.user_id]
+
+    # Called once the post has been committed, the database broker finds it on its own
+    def post_created(self, post):
+        if self.app.config['STREAM_BROKER'] != 'database':
+            self.publish(post.id, post.user_id, post.author.username)
+
+    # Only the followers that have a stream open in this process are looked up, nothing is queried when nobody is connected
+    def publish(self, post_id, author_id, username):
+        with self.lock:
+            self.published += 1
+            connected = list(self.subscribers)
+        if not connected:
+            return
+        recipients = db.session.scalars(
+            sa.select(followers.c.follower_id).where(
+                followers.c.followed_id == author_id,
+                followers.c.follower_id.in_(connected))).all()
+        message = {'id': post_id, 'author': username}
+        with self.lock:
+            for user_id in recipients:
+                for subscriber in self.subscribers.get(user_id, ()):
+                    try:
+                        subscriber.queue.put_nowait(message)
+                        self.delivered += 1
+                    except Full:
+                        subscriber.dropped += 1
+                        self.dropped += 1
+
+    def start(self):
+        with self.lock:
+            if self.poller is not None:
+                return
+            self.poller = Thread(target=self.poll, daemon=True)
+            self.poller.start()
+
+    # Database broker, publishes the posts added since the last poll
+    # The thread exits once the last connection closes, and the next subscriber starts another one
+    def poll(self):
+        last_id = None
+        while True:
+            with self.lock:
+                if not self.subscribers:
+                    self.poller = None
+                    return
+            try:
+                with self.app.app_context():
+                    if last_id is None:
+                        last_id = db.session.scalar(
+                            sa.select(sa.func.max(Post.id))) or 0
+                    rows = db.session.execute(
+                        sa.select(Post.id, Post.user_id, User.username)
+                        .join(Post.author).where(Post.id > last_id)
+                        .order_by(Post.id)).all()
+                    for post_id, author_id, username in rows:
+                        self.publish(post_id, author_id, username)
+                        last_id = post_id
+            except Exception:
+                self.app.logger.exception('Polling for new posts failed')
+            sleep(self.app.config['STREAM_POLL_INTERVAL'])
+
+    # Server-sent events for one connection, taken by subscribe() before the response starts
+    # A comment line every STREAM_HEARTBEAT seconds keeps proxies from closing an idle connection and lets the server notice a client
+    # that went away (the write fails and the generator is closed), the subscription is dropped either way
+    # The response ends after STREAM_MAX_AGE seconds and the browser reconnects, so no worker thread is held for good
+    def events(self, subscriber):
+        heartbeat = self.app.config['STREAM_HEARTBEAT']
+        deadline = monotonic() + self.app.config['STREAM_MAX_AGE']
+        try:
+            yield 'retry: {}\n\n'.format(self.app.config['STREAM_RETRY'])
+            while monotonic() < deadline:
+                try:
+                    message = subscriber.queue.get(timeout=heartbeat)
+                except Empty:
+                    yield ': heartbeat\n\n'
+                    continue
+                yield 'id: {}\nevent: post\ndata: {}\n\n'.format(
+                    message['id'], json.dumps(message))
+        finally:
+            self.unsubscribe(subscriber)
+
+    # Called with the lock held
+    def connections(self):
+        return sum(len(subscribers) for subscribers
+                   in self.subscribers.values())
+
+    def stats(self):
+        with self.lock:
+            return {
+                'connections': self.connections(),
+                'published': self.published,
+                'delivered': self.delivered,
+                'dropped': self.dropped,
+                'rejected': self.rejected,
+            }
+
+
+post_stream = PostStream()
@@ -1,31 +1,188 @@
+import hashlib
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from time import monotonic
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+import sqlalchemy as sa
 from flask_babel import _
 from flask import current_app
+from app import db
+from app.models import Translation
+
+# Cache of translation results keyed on (text hash, source, dest)
+# Entries live in a bounded in-memory LRU with a TTL, optionally backed by the translation table so hits survive restarts and are shared by worker processes
+class TranslationCache:
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['translation_cache'] = self
+        self.clear()
+
+    @staticmethod
+    def key(text, source_language, dest_language):
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return digest, source_language, dest_language
+
+    def get(self, key):
+        now = monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, text = entry
+                if expires > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return text
+                del self.entries[key]
+        text = self.load(key) if self.app.config['TRANSLATION_CACHE_PERSIST'] \
+            else None
+        with self.lock:
+            if text is None:
+                self.misses += 1
+                return None
+            self.store_hits += 1
+        self.remember(key, text)
+        return text
+
+    def set(self, key, text):
+        self.remember(key, text)
+        if self.app.config['TRANSLATION_CACHE_PERSIST']:
+            self.store(key, text)
+
+    def remember(self, key, text):
+        with self.lock:
+            self.entries[key] = (
+                monotonic() + self.app.config['TRANSLATION_CACHE_TTL'], text)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.app.config['TRANSLATION_CACHE_SIZE']:
+                self.entries.popitem(last=False)
+
+    def load(self, key):
+        text_hash, source_language, dest_language = key
+        oldest = datetime.now(timezone.utc) - timedelta(
+            seconds=self.app.config['TRANSLATION_CACHE_TTL'])
+        with db.engine.connect() as connection:
+            return connection.scalar(
+                sa.select(Translation.text).where(
+                    Translation.text_hash == text_hash,
+                    Translation.source_language == source_language,
+                    Translation.dest_language == dest_language,
+                    Translation.timestamp > oldest))
+
+    # Written on a separate connection so the request's session is left alone
+    def store(self, key, text):
+        text_hash, source_language, dest_language = key
+        table = Translation.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.delete().where(
+                table.c.text_hash == text_hash,
+                table.c.source_language == source_language,
+                table.c.dest_language == dest_language))
+            connection.execute(table.insert().values(
+                text_hash=text_hash, source_language=source_language,
+                dest_language=dest_language, text=text,
+                timestamp=datetime.now(timezone.utc)))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.store_hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits,
+                    'store_hits': self.store_hits, 'misses': self.misses}
+
+
+cache = TranslationCache()
+
+
+# Shared keep-alive connection pool to the translator service, with retries on transient failures
+# The session is created on first use and reused by every request in the process
+_session = None
+_session_lock = Lock()
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            retries = Retry(
+                total=current_app.config['MS_TRANSLATOR_RETRIES'],
+                backoff_factor=0.2,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=['POST'])
+            adapter = HTTPAdapter(
+                pool_maxsize=current_app.config['MS_TRANSLATOR_POOL_SIZE'],
+                max_retries=retries)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
 
 def translate(text, source_language, dest_language):
+    return translate_batch([text], source_language, dest_language)[0]
+
+
+# Translates a list of texts with one service call per MS_TRANSLATOR_BATCH_SIZE texts, using the array form of the request body
+# Returns the translations in the same order, cached texts are not sent again
+def translate_batch(texts, source_language, dest_language):
     # Checks if there is a key for the translation service in the config else return error string
     if 'MS_TRANSLATOR_KEY' not in current_app.config or \
             not current_app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: the translation service is not configured.')
-    
+        return [_('Error: the translation service is not configured.')] * \
+            len(texts)
+
+    # Popular posts get translated into the same language over and over, so results are cached
+    keys = [cache.key(text, source_language, dest_language) for text in texts]
+    results = [cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+
     # To authenticate with the service the key and region of the translator resource needs to be provided in the header with the following names:
     auth = {
         'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
-        'Ocp-Apim-Subscription-Region': 'uksouth',
+        'Ocp-Apim-Subscription-Region': current_app.config['MS_TRANSLATOR_REGION'],
     }
-    
-    # post() method from the requests package sends an HTTP request with a POST method to the URL given as the first argument
-    # Base URL + path for the translation endpoint
-    # API version required argument
-    # from and to for source and destination languages 
-    # Text to translate needs to be given in JSON format
-    # returns a response object containing all the details provided by the service
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com'
-        '/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language), headers=auth, json=[{'Text': text}])
-    # Check status code is 200 (for successful request)
-    if r.status_code != 200:
-        return _('Error: the translation service failed.')
-    # Body of the response has a JSON encoded string translation and since a single text is being translated, it will always be the first element to get
-    return r.json()[0]['translations'][0]['text']
\ No newline at end of file
+
+    batch_size = current_app.config['MS_TRANSLATOR_BATCH_SIZE']
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        # post() method sends an HTTP request with a POST method to the URL given as the first argument
+        # Base URL + path for the translation endpoint
+        # API version required argument
+        # from and to for source and destination languages
+        # Texts to translate need to be given in JSON format, one {'Text': ...} object per text
+        # returns a response object containing all the details provided by the service
+        try:
+            r = get_session().post(
+                current_app.config['MS_TRANSLATOR_URL'] +
+                '/translate?api-version=3.0&from={}&to={}'.format(
+                    source_language, dest_language), headers=auth,
+                json=[{'Text': texts[i]} for i in batch],
+                timeout=current_app.config['MS_TRANSLATOR_TIMEOUT'])
+        except requests.RequestException:
+            r = None
+        # Check status code is 200 (for successful request), failures are not cached
+        if r is None or r.status_code != 200:
+            for i in batch:
+                results[i] = _('Error: the translation service failed.')
+            continue
+        # Body of the response has one element per text, in the order they were sent
+        for i, item in zip(batch, r.json()):
+            results[i] = item['translations'][0]['text']
+            cache.set(keys[i], results[i])
+    return results
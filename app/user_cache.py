@@ -0,0 +1,74 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+# Per-process cache of the logged in users' columns, so that loading the user of a session doesn't need a query
+# Entries expire after USER_CACHE_TTL seconds (0 disables the cache), which bounds how stale another process's view can be,
+# and are dropped by this process when the profile is edited, the password is reset or the user logs out
+class UserCache:
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['user_cache'] = self
+        self.clear()
+
+    def enabled(self):
+        return self.app is not None and self.app.config['USER_CACHE_TTL'] > 0
+
+    def get(self, user_id):
+        if not self.enabled():
+            return None
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] > monotonic():
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return dict(entry[1])
+            self.entries.pop(user_id, None)
+            self.misses += 1
+
+    def set(self, user_id, values):
+        if not self.enabled():
+            return
+        expires = monotonic() + self.app.config['USER_CACHE_TTL']
+        with self.lock:
+            self.entries[user_id] = (expires, dict(values))
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.app.config['USER_CACHE_SIZE']:
+                self.entries.popitem(last=False)
+
+    # Changes a cached entry in place, without extending its lifetime
+    def update(self, user_id, **values):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None:
+                entry[1].update(values)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': round(self.hits / lookups, 3)
+                    if lookups else None}
+
+
+cache = UserCache()
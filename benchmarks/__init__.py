@@ -0,0 +1,10 @@
+from config import Config
+
+
+# Configuration shared by the benchmarks, pointing at a throwaway database
+class BenchmarkConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    WTF_CSRF_ENABLED = False
+    # The benchmarks send far more requests than the rate limits allow
+    RATELIMIT_ENABLED = False
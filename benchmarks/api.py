@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Compares the JSON feed API with the HTML pages showing the same posts
+# Reports the time per request and the response size of each pair of endpoints
+# Usage: python -m benchmarks.api [--requests N] [--users N] [--posts N]
+import argparse
+import json
+from time import perf_counter
+from app import create_app, db
+from benchmarks import BenchmarkConfig
+from benchmarks.seed import PASSWORD, seed
+
+PAIRS = [
+    ('explore', '/explore', '/api/v1/timeline/explore'),
+    ('home', '/index', '/api/v1/timeline/home'),
+    ('user', '/user/user1', '/api/v1/users/user1/posts'),
+    ('explore_sparse', '/explore', '/api/v1/timeline/explore?fields=id,body'),
+]
+
+
+def measure(client, url, requests, headers=None):
+    response = client.get(url, headers=headers)
+    if response.status_code != 200:
+        raise RuntimeError('{} returned {}'.format(url, response.status_code))
+    start = perf_counter()
+    for i in range(requests):
+        client.get(url, headers=headers)
+    elapsed = perf_counter() - start
+    return {'ms_per_request': round(elapsed * 1000 / requests, 3),
+            'bytes': len(response.data)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='JSON feed API against the HTML feed pages.')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts', type=int, default=10000)
+    args = parser.parse_args()
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        seed(args.users, args.posts)
+    # Requests run without an outer application context, so that each one gets its own 'g'
+    browser = app.test_client()
+    browser.post('/auth/login', data={'username': 'user1',
+                                      'password': PASSWORD})
+    api = app.test_client()
+    token = api.post('/api/v1/tokens', auth=('user1', PASSWORD)).json['token']
+    headers = {'Authorization': 'Bearer ' + token}
+    results = {'benchmark': 'api', 'requests': args.requests, 'pages': {}}
+    for name, html_url, api_url in PAIRS:
+        html = measure(browser, html_url, args.requests)
+        data = measure(api, api_url, args.requests, headers)
+        results['pages'][name] = {
+            'html': html, 'api': data,
+            'speedup': round(html['ms_per_request'] /
+                             data['ms_per_request'], 2),
+            'size_ratio': round(html['bytes'] / data['bytes'], 2),
+        }
+    with app.app_context():
+        app.extensions['language_detector'].join()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
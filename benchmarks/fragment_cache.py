@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# Compares the time it takes to render a full feed page with the post fragment cache on and off
+# Usage: python -m benchmarks.fragment_cache [--requests N]
+import argparse
+import json
+from time import perf_counter
+from app import create_app, db
+from app.models import User, Post
+from benchmarks import BenchmarkConfig
+
+
+def setup(app):
+    users = [User(username='user{}'.format(i),
+                  email='user{}@example.com'.format(i)) for i in range(25)]
+    users[0].set_password('cat')
+    db.session.add_all(users)
+    db.session.add_all([Post(body='post number {} from {}'.format(i, u.username),
+                             author=u, language='es')
+                        for i, u in enumerate(users * 2)])
+    db.session.commit()
+    client = app.test_client()
+    client.post('/auth/login', data={'username': 'user0', 'password': 'cat'})
+    return client
+
+
+def measure(app, client, requests):
+    client.get('/explore')
+    start = perf_counter()
+    for i in range(requests):
+        client.get('/explore')
+    elapsed = perf_counter() - start
+    return {'requests': requests, 'seconds': round(elapsed, 4),
+            'ms_per_page': round(elapsed * 1000 / requests, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Feed rendering with and without the fragment cache.')
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        client = setup(app)
+        app.config['FRAGMENT_CACHE_ENABLED'] = False
+        disabled = measure(app, client, args.requests)
+        app.config['FRAGMENT_CACHE_ENABLED'] = True
+        enabled = measure(app, client, args.requests)
+        results = {
+            'benchmark': 'fragment_cache',
+            'cache_disabled': disabled,
+            'cache_enabled': enabled,
+            'speedup': round(disabled['seconds'] / enabled['seconds'], 2),
+            'cache': app.extensions['fragment_cache'].stats(),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
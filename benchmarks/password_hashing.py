@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# Login throughput for a set of password hashing settings
+# For each PASSWORD_HASH_METHOD, reports the time of one hash, sequential /auth/login requests per second
+# and password verifications per second when --concurrency threads log in at the same time through the hashing pool
+# Usage: python -m benchmarks.password_hashing [--logins N] [--concurrency N] [--method METHOD ...]
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from app import create_app, db
+from app.models import User
+from benchmarks import BenchmarkConfig
+
+METHODS = ['scrypt:32768:8:1', 'scrypt:16384:8:1', 'pbkdf2:sha256:600000',
+           'pbkdf2:sha256:260000']
+PASSWORD = 'correct horse battery staple'
+
+
+def measure(method, logins, concurrency):
+    class MethodConfig(BenchmarkConfig):
+        PASSWORD_HASH_METHOD = method
+        PASSWORD_HASH_WORKERS = concurrency
+        PASSWORD_HASH_QUEUE_SIZE = concurrency
+    app = create_app(MethodConfig)
+    hasher = app.extensions['password_hasher']
+    with app.app_context():
+        db.create_all()
+        user = User(username='john', email='john@example.com')
+        start = perf_counter()
+        user.set_password(PASSWORD)
+        hash_ms = (perf_counter() - start) * 1000
+        db.session.add(user)
+        db.session.commit()
+        pwhash = user.password_hash
+
+    # Each login uses a fresh client, outside of an application context so that nothing is shared between requests
+    start = perf_counter()
+    for i in range(logins):
+        response = app.test_client().post('/auth/login', data={
+            'username': 'john', 'password': PASSWORD})
+        if response.status_code != 302:
+            raise RuntimeError('login returned {}'.format(
+                response.status_code))
+    login_seconds = perf_counter() - start
+
+    with app.app_context():
+        start = perf_counter()
+        with ThreadPoolExecutor(concurrency) as clients:
+            results = list(clients.map(
+                lambda i: hasher.verify(pwhash, PASSWORD), range(logins)))
+        verify_seconds = perf_counter() - start
+        db.engine.dispose()
+    assert all(results)
+    return {
+        'method': method,
+        'hash_ms': round(hash_ms, 2),
+        'logins_per_sec': round(logins / login_seconds, 2),
+        'concurrent_verifications_per_sec': round(logins / verify_seconds, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Login throughput per password hashing setting.')
+    parser.add_argument('--logins', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='hashing threads and simultaneous logins')
+    parser.add_argument('--method', action='append',
+                        help='hash method to measure (can be repeated), '
+                             'defaults to a few scrypt and pbkdf2 costs')
+    args = parser.parse_args()
+    results = {
+        'benchmark': 'password_hashing',
+        'logins': args.logins,
+        'concurrency': args.concurrency,
+        'methods': [measure(method, args.logins, args.concurrency)
+                    for method in args.method or METHODS],
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
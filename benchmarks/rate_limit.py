@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# Cost of a rate limit check
+# Reports the time of one check of each algorithm against the in-memory and the SQLite storage, for a single key and for --keys keys
+# Usage: python -m benchmarks.rate_limit [--checks N] [--keys N]
+import argparse
+import json
+import os
+import tempfile
+from time import perf_counter, time
+from app.ratelimit import ALGORITHMS, MemoryStorage, SQLiteStorage
+
+
+def measure(storage, algorithm, checks, keys):
+    start = perf_counter()
+    for i in range(checks):
+        storage.hit('{}:{}'.format(algorithm.__name__, i % keys), algorithm,
+                    time(), 10 ** 9, 60)
+    return round((perf_counter() - start) * 10 ** 6 / checks, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rate limit check overhead.')
+    parser.add_argument('--checks', type=int, default=20000)
+    parser.add_argument('--keys', type=int, default=1000)
+    args = parser.parse_args()
+    results = {'benchmark': 'rate_limit', 'checks': args.checks,
+               'us_per_check': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        storages = {
+            'memory': MemoryStorage(100000),
+            'sqlite': SQLiteStorage(os.path.join(tmp, 'ratelimit.db'), 1),
+        }
+        for storage_name, storage in storages.items():
+            for name, algorithm in ALGORITHMS.items():
+                results['us_per_check']['{}/{}'.format(
+                    storage_name, name)] = {
+                    'one_key': measure(storage, algorithm, args.checks, 1),
+                    'many_keys': measure(storage, algorithm, args.checks,
+                                         args.keys),
+                }
+        storages['sqlite'].local.connection.close()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
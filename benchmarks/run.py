@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# Load test of the core request paths against a seeded SQLite database
+# Drives index, explore, user, follow, post creation and login through the Flask test client and reports
+# p50/p95/p99 latency and throughput per endpoint as JSON
+# Usage: python -m benchmarks.run [--database FILE] [--users N] [--posts N] [--requests N] [--output FILE]
+import argparse
+import html
+import json
+import os
+import random
+import re
+import tempfile
+from statistics import mean, quantiles
+from time import perf_counter
+import sqlalchemy as sa
+from app import create_app, db
+from app.models import User
+from benchmarks.seed import PASSWORD, database_config, seed
+
+
+def percentiles(samples):
+    cuts = quantiles(samples, n=100, method='inclusive')
+    return {'p50': cuts[49], 'p95': cuts[94], 'p99': cuts[98]}
+
+
+def summarize(samples, elapsed):
+    ms = [sample * 1000 for sample in samples]
+    summary = {'requests': len(ms), 'mean_ms': mean(ms)}
+    summary.update({name + '_ms': value
+                    for name, value in percentiles(ms).items()})
+    summary['throughput_rps'] = len(ms) / elapsed
+    return {key: round(value, 3) for key, value in summary.items()}
+
+
+# Pages of the home feed walked through by the 'index_deep' scenario
+DEEP_PAGE = 20
+
+
+# URL of the DEEP_PAGE-th page of the client's home feed (or its last page), found by following the 'Older posts' cursor links
+def deep_url(client, pages=DEEP_PAGE):
+    url = '/index'
+    for i in range(pages - 1):
+        found = re.search(r'href="([^"]*)">\s*Older posts',
+                          client.get(url).text)
+        # the link of the last page is disabled and rendered as href="None"
+        if found is None or found.group(1) == 'None':
+            break
+        url = html.unescape(found.group(1))
+    return url
+
+
+# Each scenario is a function that issues one request, given a logged in client and a random generator
+# 'deep_urls' maps each logged in client to its deep_url()
+def scenarios(users, deep_urls):
+    def username(rng):
+        return 'user{}'.format(rng.randint(1, users))
+
+    return {
+        'index': lambda client, rng: client.get('/index'),
+        'index_deep': lambda client, rng: client.get(deep_urls[client]),
+        'explore': lambda client, rng: client.get('/explore'),
+        'user': lambda client, rng: client.get('/user/' + username(rng)),
+        'follow': lambda client, rng: client.post(
+            '/follow/' + username(rng), data={}),
+        'post': lambda client, rng: client.post(
+            '/index', data={'post': 'benchmark post {}'.format(
+                rng.random())}),
+        'login': lambda client, rng: client.post(
+            '/auth/login', data={'username': username(rng),
+                                 'password': PASSWORD}),
+    }
+
+
+def run(app, users, requests, clients, rng):
+    results = {}
+    sessions = []
+    for i in range(clients):
+        client = app.test_client()
+        client.post('/auth/login', data={
+            'username': 'user{}'.format(rng.randint(1, users)),
+            'password': PASSWORD})
+        sessions.append(client)
+    deep_urls = {client: deep_url(client) for client in sessions}
+    for name, request in scenarios(users, deep_urls).items():
+        # Login requests need a fresh client, the others reuse the logged in ones
+        pick = (lambda: app.test_client()) if name == 'login' else \
+            (lambda: rng.choice(sessions))
+        request(pick(), rng)
+        samples = []
+        start = perf_counter()
+        for i in range(requests):
+            client = pick()
+            t = perf_counter()
+            response = request(client, rng)
+            samples.append(perf_counter() - t)
+            if response.status_code >= 400:
+                raise RuntimeError('{} returned {}'.format(
+                    name, response.status_code))
+        results[name] = summarize(samples, perf_counter() - start)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the core microblog request paths.')
+    parser.add_argument('--database',
+                        help='seeded SQLite database to use (a temporary '
+                             'one is seeded when not given)')
+    parser.add_argument('--users', type=int, default=1000,
+                        help='users to seed (counted in the database when '
+                             '--database is given)')
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per endpoint')
+    parser.add_argument('--clients', type=int, default=20,
+                        help='logged in users the requests are spread over')
+    parser.add_argument('--timeline', action='store_true',
+                        help='serve the home feed from the timeline store')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report to a file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.database or os.path.join(tmp, 'benchmark.db')
+        config = database_config(path)
+        config.TIMELINE_ENABLED = args.timeline
+        app = create_app(config)
+        with app.app_context():
+            users = args.users
+            if args.database is None:
+                db.create_all()
+                dataset = seed(users, args.posts, seed=args.seed)
+            else:
+                # The seeded users are user1 to userN
+                users = db.session.scalar(sa.select(sa.func.count(User.id)))
+                dataset = {'database': args.database, 'users': users}
+            if args.timeline:
+                app.test_cli_runner().invoke(args=['timeline', 'rebuild'])
+        # Requests run without an outer application context, so that each one gets its own 'g' and logged in user
+        endpoints = run(app, users, args.requests, args.clients, rng)
+        with app.app_context():
+            app.extensions['language_detector'].join()
+            db.engine.dispose()
+        report = {
+            'dataset': dataset,
+            'options': {'requests': args.requests, 'clients': args.clients,
+                        'timeline': args.timeline},
+            'endpoints': endpoints,
+        }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Seeds a synthetic dataset into an SQLite database for the benchmarks
+# Follow counts and the popularity of accounts both follow power laws, so a few celebrity accounts get most followers, like in a real social network
+# Usage: python -m benchmarks.seed DATABASE --users N --posts N
+import argparse
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+from time import perf_counter
+from app import create_app, db
+from app.passwords import hasher as password_hasher
+from app.models import User, Post, followers
+from benchmarks import BenchmarkConfig
+
+# Password of every seeded user
+PASSWORD = 'password'
+CHUNK_SIZE = 10000
+WORDS = ('the quick brown fox jumps over lazy dog hello world microblog '
+         'post today great news coffee music code python flask sqlite '
+         'weekend travel photo friends').split()
+
+
+def database_config(path):
+    class SeededConfig(BenchmarkConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+    return SeededConfig
+
+
+def insert(table, rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(table.insert(), rows[start:start + CHUNK_SIZE])
+    db.session.commit()
+
+
+def power_law(rng, alpha, limit):
+    return min(int(rng.paretovariate(alpha)), limit)
+
+
+# Creates the users, the follower graph and the posts with bulk executemany inserts
+# Returns the number of rows written to each table
+def seed(users, posts, avg_following=20, alpha=1.5, seed=0):
+    rng = random.Random(seed)
+    password_hash = password_hasher.hash(PASSWORD)
+    now = datetime.now(timezone.utc)
+
+    # Account popularity: the user with rank r is picked with weight 1/r^alpha
+    ids = list(range(1, users + 1))
+    weights = list(accumulate(1 / rank ** alpha for rank in ids))
+    edges = set()
+    for follower in ids:
+        count = power_law(rng, alpha, users - 1) * avg_following // 3
+        for followed in rng.choices(ids, cum_weights=weights,
+                                    k=max(count, 1)):
+            if followed != follower:
+                edges.add((follower, followed))
+    num_followers = dict.fromkeys(ids, 0)
+    num_following = dict.fromkeys(ids, 0)
+    for follower, followed in edges:
+        num_following[follower] += 1
+        num_followers[followed] += 1
+
+    # Some users post a lot more than others too
+    authors = rng.choices(ids, weights=[power_law(rng, alpha, 1000)
+                                        for i in ids], k=posts)
+    num_posts = dict.fromkeys(ids, 0)
+    for author in authors:
+        num_posts[author] += 1
+
+    insert(User.__table__, [{
+        'id': i, 'username': 'user{}'.format(i),
+        'email': 'user{}@example.com'.format(i),
+        'password_hash': password_hash, 'last_seen': now,
+        'num_followers': num_followers[i], 'num_following': num_following[i],
+        'num_posts': num_posts[i]} for i in ids])
+    insert(followers, [{'follower_id': follower, 'followed_id': followed}
+                       for follower, followed in edges])
+    # Generated and inserted one chunk at a time, so millions of posts don't need to fit in memory at once
+    for start in range(0, posts, CHUNK_SIZE):
+        insert(Post.__table__, [{
+            'body': ' '.join(rng.choices(WORDS, k=rng.randint(3, 20))),
+            'timestamp': now - timedelta(seconds=posts - i),
+            'user_id': authors[i], 'language': 'en'}
+            for i in range(start, min(start + CHUNK_SIZE, posts))])
+    return {'users': users, 'followers': len(edges), 'posts': posts}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Seed a synthetic microblog dataset.')
+    parser.add_argument('database', help='SQLite database file to create')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--avg-following', type=int, default=20)
+    parser.add_argument('--alpha', type=float, default=1.5,
+                        help='power law exponent of the follower graph')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    app = create_app(database_config(args.database))
+    with app.app_context():
+        db.create_all()
+        start = perf_counter()
+        rows = seed(args.users, args.posts, args.avg_following, args.alpha,
+                    args.seed)
+        rows['seconds'] = round(perf_counter() - start, 2)
+    print(json.dumps(rows, indent=2))
+
+
+if __name__ == '__main__':
+    main()
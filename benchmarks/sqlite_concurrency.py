@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Mixed read/write throughput of a seeded SQLite database with the default settings and with the production profile (SQLITE_PRODUCTION)
+# Reader threads run the explore feed query and writer threads publish posts (post insert plus counter update, one transaction each) for a fixed time
+# Usage: python -m benchmarks.sqlite_concurrency [--readers N] [--writers N] [--seconds N] [--users N] [--posts N]
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+from threading import Event, Thread
+from time import perf_counter, sleep
+import sqlalchemy as sa
+from app import create_app, db
+from app.models import User, Post
+from benchmarks.run import percentiles
+from benchmarks.seed import database_config, seed
+
+
+def read(connection, rng, posts):
+    query = (sa.select(Post.id, Post.body, Post.timestamp, User.username)
+             .join(Post.author).order_by(Post.timestamp.desc())
+             .limit(25).offset(rng.randrange(max(posts - 25, 1))))
+    connection.execute(query).all()
+
+
+def write(connection, rng, users):
+    user_id = rng.randint(1, users)
+    connection.execute(sa.insert(Post), {
+        'body': 'benchmark post {}'.format(rng.random()), 'user_id': user_id,
+        'language': 'en'})
+    connection.execute(sa.update(User).where(User.id == user_id)
+                       .values(num_posts=User.num_posts + 1))
+
+
+def worker(app, operation, args, rng, stop, samples, errors):
+    with app.app_context():
+        while not stop.is_set():
+            start = perf_counter()
+            try:
+                with db.engine.begin() as connection:
+                    operation(connection, rng, args)
+            except sa.exc.OperationalError:
+                errors.append(1)
+                continue
+            samples.append(perf_counter() - start)
+
+
+def measure(path, production, args):
+    config = database_config(path)
+    config.SQLITE_PRODUCTION = production
+    config.DATABASE_POOL_SIZE = args.readers + args.writers
+    config.LANGUAGE_DETECTION_WORKERS = 0
+    app = create_app(config)
+    stop = Event()
+    results = {}
+    threads = []
+    for name, operation, count, extra in [
+            ('reads', read, args.readers, args.posts),
+            ('writes', write, args.writers, args.users)]:
+        samples, errors = [], []
+        results[name] = (samples, errors)
+        for i in range(count):
+            threads.append(Thread(target=worker, args=(
+                app, operation, extra, random.Random(len(threads)), stop,
+                samples, errors)))
+    for thread in threads:
+        thread.start()
+    sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    with app.app_context():
+        with db.engine.connect() as connection:
+            journal_mode = connection.exec_driver_sql(
+                'PRAGMA journal_mode').scalar()
+        db.engine.dispose()
+    report = {'journal_mode': journal_mode}
+    for name, (samples, errors) in results.items():
+        ms = [sample * 1000 for sample in samples]
+        report[name] = {'per_sec': round(len(ms) / args.seconds, 1),
+                        'errors': len(errors)}
+        if len(ms) > 1:
+            report[name].update({key + '_ms': round(value, 3) for key, value
+                                 in percentiles(ms).items()})
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='SQLite read/write throughput with and without the '
+                    'production profile.')
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=50000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        seeded = os.path.join(tmp, 'seeded.db')
+        app = create_app(database_config(seeded))
+        with app.app_context():
+            db.create_all()
+            seed(args.users, args.posts)
+            db.engine.dispose()
+        results = {'benchmark': 'sqlite_concurrency',
+                   'readers': args.readers, 'writers': args.writers,
+                   'seconds': args.seconds}
+        # Each run starts from its own copy of the seeded database
+        for name, production in [('default', False), ('production', True)]:
+            path = os.path.join(tmp, name + '.db')
+            shutil.copy(seeded, path)
+            results[name] = measure(path, production, args)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
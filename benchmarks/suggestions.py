@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Who to follow suggestions on a power-law followers graph
+# Reports the time of a full 'flask suggestions rebuild' for each batch size and the peak memory of the process during it,
+# then the time of a follow() and an unfollow() that update the suggestions incrementally
+# Usage: python -m benchmarks.suggestions [--users N] [--following N] [--batch-size N ...]
+import argparse
+import json
+import resource
+from time import perf_counter
+import sqlalchemy as sa
+from app import create_app, db
+from app.models import User, followers, suggestion
+from benchmarks import BenchmarkConfig
+from benchmarks.seed import seed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Suggestions rebuild and incremental updates.')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--following', type=int, default=20,
+                        help='Average number of accounts followed.')
+    parser.add_argument('--batch-size', type=int, nargs='+',
+                        default=[100, 1000])
+    args = parser.parse_args()
+    app = create_app(BenchmarkConfig)
+    results = {'benchmark': 'suggestions', 'users': args.users,
+               'rebuild': {}}
+    with app.app_context():
+        db.create_all()
+        seed(args.users, 0, avg_following=args.following)
+        results['edges'] = db.session.scalar(
+            sa.select(sa.func.count()).select_from(followers))
+        runner = app.test_cli_runner()
+        for batch_size in args.batch_size:
+            start = perf_counter()
+            result = runner.invoke(args=['suggestions', 'rebuild',
+                                         '--batch-size', str(batch_size)])
+            if result.exit_code:
+                raise RuntimeError(result.output)
+            results['rebuild'][batch_size] = {
+                'seconds': round(perf_counter() - start, 3),
+                'max_rss_mb': round(resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            }
+        results['stored'] = db.session.scalar(
+            sa.select(sa.func.count()).select_from(suggestion))
+
+        user = db.session.get(User, args.users)
+        followed = db.session.get(User, 1)
+        if user.is_following(followed):
+            user.unfollow(followed)
+            db.session.commit()
+        start = perf_counter()
+        user.follow(followed)
+        db.session.commit()
+        results['follow_ms'] = round((perf_counter() - start) * 1000, 3)
+        start = perf_counter()
+        user.unfollow(followed)
+        db.session.commit()
+        results['unfollow_ms'] = round((perf_counter() - start) * 1000, 3)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,29 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     
+    # Production SQLite profile, applied to file databases when SQLITE_PRODUCTION is set
+    # WAL journal (readers don't wait for the writer), synchronous=NORMAL (safe with WAL, only fsyncs at checkpoints), writers wait busy_timeout milliseconds for the lock
+    # instead of failing, reads go through a memory map of up to mmap_size bytes and each connection caches up to cache_size KiB (negative values are KiB) of pages
+    SQLITE_PRODUCTION = os.environ.get('SQLITE_PRODUCTION') is not None
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000),
+        'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE') or 256 * 1024 * 1024),
+        'cache_size': -int(os.environ.get('SQLITE_CACHE_SIZE') or 64 * 1024),
+    }
+    # Pooled connections per process, one for each thread serving requests plus a few for the background workers (language detection, last seen, password rehashing)
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or os.environ.get('WEB_THREADS') or 4)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 4)
+    DATABASE_POOL_TIMEOUT = 10
+    
+    # Read replicas (comma separated database URLs) serving the queries of the feed pages, replication itself is left to the database
+    DATABASE_REPLICA_URLS = [url for url in
+                             (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',')
+                             if url]
+    # Seconds a user's pages keep reading from the primary after they post, follow or edit their profile
+    REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS') or 10)
+    
     # Email server details for sending errors by email
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
@@ -21,13 +44,125 @@ class Config:
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['your-email@example.com']
+    # Outbound mail queue: worker threads (one SMTP connection each), queued messages, seconds a sender waits for room,
+    # attempts per message after the first one and the base delay between them, and seconds before an idle connection is closed
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 100)
+    MAIL_QUEUE_TIMEOUT = 2
+    MAIL_RETRIES = 3
+    MAIL_RETRY_DELAY = 1
+    MAIL_IDLE_TIMEOUT = 30
+    # Seconds the process waits on exit for the queued mail to be sent
+    MAIL_SHUTDOWN_TIMEOUT = int(os.environ.get('MAIL_SHUTDOWN_TIMEOUT') or 10)
+    
+    # Logging goes through a queue of LOG_QUEUE_SIZE records to a background thread, the log file is rotated at LOG_MAX_BYTES and LOG_FORMAT is 'text' or 'json'
+    # At most LOG_MAIL_LIMIT error emails are sent every LOG_MAIL_INTERVAL seconds, and the same error only once in that time
+    LOG_FORMAT = os.environ.get('LOG_FORMAT') or 'text'
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES') or 10 * 1024 * 1024)
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT') or 10)
+    LOG_QUEUE_SIZE = 10000
+    LOG_MAIL_INTERVAL = int(os.environ.get('LOG_MAIL_INTERVAL') or 300)
+    LOG_MAIL_LIMIT = int(os.environ.get('LOG_MAIL_LIMIT') or 10)
+    
+    # Per-request SQL and timing instrumentation (Server-Timing headers, request log lines and /admin/metrics)
+    # Statements slower than INSTRUMENTATION_SLOW_QUERY seconds are sampled
+    INSTRUMENTATION_ENABLED = os.environ.get('INSTRUMENTATION_ENABLED') is not None
+    INSTRUMENTATION_SLOW_QUERY = float(os.environ.get('INSTRUMENTATION_SLOW_QUERY') or 0.1)
+    INSTRUMENTATION_SLOW_QUERY_SAMPLES = 100
     
     # For pagination
     POSTS_PER_PAGE = 25
+    # JSON API: largest page a client can ask for with ?limit= and lifetime of its tokens (seconds)
+    API_MAX_PER_PAGE = 100
+    API_TOKEN_EXPIRATION = 3600
+    # Rows fetched per round trip when streaming a post history download
+    EXPORT_CHUNK_SIZE = 1000
+    
+    # Rate limits of the expensive endpoints as 'N/second|minute|hour|day', counted per user or per address when logged out
+    # Each process keeps its own counts in memory (at most RATELIMIT_STORAGE_SIZE keys), unless RATELIMIT_STORAGE_URL names a SQLite
+    # file (e.g. sqlite:////tmp/ratelimit.db) shared by all the processes of the host, whose lock is waited for RATELIMIT_STORAGE_TIMEOUT seconds
+    # Limits by address see the address of the client only when REVERSE_PROXIES is the number of proxies in front of the application
+    # (their X-Forwarded-For and X-Forwarded-Proto headers are trusted), otherwise every client behind a proxy shares the proxy's limit
+    RATELIMIT_ENABLED = os.environ.get('RATELIMIT_DISABLED') is None
+    RATELIMIT_STORAGE_URL = os.environ.get('RATELIMIT_STORAGE_URL')
+    RATELIMIT_STORAGE_SIZE = 100000
+    RATELIMIT_STORAGE_TIMEOUT = 1
+    RATELIMIT_LOGIN = os.environ.get('RATELIMIT_LOGIN') or '10/minute'
+    RATELIMIT_RESET_PASSWORD = os.environ.get('RATELIMIT_RESET_PASSWORD') or '5/hour'
+    RATELIMIT_TRANSLATE = os.environ.get('RATELIMIT_TRANSLATE') or '30/minute'
+    RATELIMIT_POST = os.environ.get('RATELIMIT_POST') or '10/minute'
+    REVERSE_PROXIES = int(os.environ.get('REVERSE_PROXIES') or 0)
+    
+    # Server-sent events of new posts: with 'memory' a post is announced by the process that saved it, with 'database' every process polls
+    # the post table each STREAM_POLL_INTERVAL seconds so connections see the posts written by the others
+    # Off unless STREAM_ENABLED is set, each open home page holds a worker thread, so it needs a server with threads to spare (gevent, many threads)
+    # Past STREAM_MAX_CONNECTIONS open connections in a process new ones get a 503 and the page doesn't offer to reload
+    # Notifications queued per connection, seconds between heartbeats and before a connection is recycled, milliseconds browsers wait to reconnect
+    STREAM_ENABLED = os.environ.get('STREAM_ENABLED') is not None
+    STREAM_MAX_CONNECTIONS = int(os.environ.get('STREAM_MAX_CONNECTIONS') or 10)
+    STREAM_BROKER = os.environ.get('STREAM_BROKER') or 'memory'
+    STREAM_POLL_INTERVAL = float(os.environ.get('STREAM_POLL_INTERVAL') or 2)
+    STREAM_QUEUE_SIZE = 100
+    STREAM_HEARTBEAT = 15
+    STREAM_MAX_AGE = 300
+    STREAM_RETRY = 3000
+    
+    # Rendered post fragments kept in memory by each process
+    FRAGMENT_CACHE_ENABLED = os.environ.get('FRAGMENT_CACHE_DISABLED') is None
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 10000)
+    
+    # Materialized home timeline (fan-out-on-write), the home feed falls back to the join query when disabled
+    TIMELINE_ENABLED = os.environ.get('TIMELINE_ENABLED') is not None
+    # Authors with more followers than this are pulled at read time instead of being fanned out
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT') or 1000)
+    # Number of recent posts copied into an inbox when following someone
+    TIMELINE_BACKFILL = int(os.environ.get('TIMELINE_BACKFILL') or 100)
+    
+    # Who to follow: suggestions kept per user by 'flask suggestions rebuild' and shown on the home page
+    # Accounts following more than SUGGESTIONS_FANOUT_LIMIT users don't count towards anyone's suggestions
+    SUGGESTIONS_PER_USER = int(os.environ.get('SUGGESTIONS_PER_USER') or 20)
+    SUGGESTIONS_SHOWN = 5
+    SUGGESTIONS_FANOUT_LIMIT = int(os.environ.get('SUGGESTIONS_FANOUT_LIMIT') or 1000)
+    
+    # Password hashing: Werkzeug method string with its cost parameters (stored hashes made with other settings are upgraded on login) and salt length
+    # Hashing runs on a pool of worker threads (0 hashes inline), with at most PASSWORD_HASH_QUEUE_SIZE requests waiting up to PASSWORD_HASH_TIMEOUT seconds for one
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt:32768:8:1'
+    PASSWORD_SALT_LENGTH = 16
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 4)
+    PASSWORD_HASH_QUEUE_SIZE = int(os.environ.get('PASSWORD_HASH_QUEUE_SIZE') or 32)
+    PASSWORD_HASH_TIMEOUT = 5
+    
+    # Logged in users are loaded from a per-process cache for this many seconds (0 disables it), entries kept by each process
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 60)
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 10000)
+    
+    # Last seen timestamps are only refreshed when older than this many seconds
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY') or 60)
+    # Buffered last seen updates are written together after this many seconds or once this many users are pending
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 30)
+    LAST_SEEN_BATCH_SIZE = int(os.environ.get('LAST_SEEN_BATCH_SIZE') or 100)
     
     # Language options
     LANGUAGES = ['en', 'es']
     
+    # Background language detection of new posts: worker threads (0 detects inline), queued posts and posts updated per batch
+    LANGUAGE_DETECTION_WORKERS = int(os.environ.get('LANGUAGE_DETECTION_WORKERS') or 2)
+    LANGUAGE_QUEUE_SIZE = 1000
+    LANGUAGE_BATCH_SIZE = 50
+    
     # Microsoft Azure translator key 
     # https://portal.azure.com/
-    MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
\ No newline at end of file
+    MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    MS_TRANSLATOR_REGION = os.environ.get('MS_TRANSLATOR_REGION') or 'uksouth'
+    MS_TRANSLATOR_URL = os.environ.get('MS_TRANSLATOR_URL') or \
+        'https://api.cognitive.microsofttranslator.com'
+    # Translator client: request timeout (seconds), retries, pooled keep-alive connections and texts sent per request
+    MS_TRANSLATOR_TIMEOUT = float(os.environ.get('MS_TRANSLATOR_TIMEOUT') or 5)
+    MS_TRANSLATOR_RETRIES = int(os.environ.get('MS_TRANSLATOR_RETRIES') or 2)
+    MS_TRANSLATOR_POOL_SIZE = int(os.environ.get('MS_TRANSLATOR_POOL_SIZE') or 10)
+    MS_TRANSLATOR_BATCH_SIZE = 100
+    
+    # Translation results cache (entries, seconds), the translation table keeps them across restarts and worker processes when persistence is on
+    TRANSLATION_CACHE_SIZE = int(os.environ.get('TRANSLATION_CACHE_SIZE') or 10000)
+    TRANSLATION_CACHE_TTL = int(os.environ.get('TRANSLATION_CACHE_TTL') or 7 * 24 * 3600)
+    TRANSLATION_CACHE_PERSIST = os.environ.get('TRANSLATION_CACHE_PERSIST') is not None
\ No newline at end of file
@@ -0,0 +1,48 @@
+"""post search index
+
+Revision ID: 37b941e20d80
+Revises: 6423258a980e
+Create Date: 2026-10-18 02:22:46.657922
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '37b941e20d80'
+down_revision = '6423258a980e'
+branch_labels = None
+depends_on = None
+
+
+# SQLite FTS5 index of post bodies, kept in sync with the post table by triggers
+# Other databases have no FTS5, so the migration does nothing there
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("CREATE VIRTUAL TABLE post_fts USING fts5("
+               "body, content='post', content_rowid='id')")
+    op.execute("CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN "
+               "INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body); "
+               "END")
+    op.execute("CREATE TRIGGER post_fts_delete AFTER DELETE ON post BEGIN "
+               "INSERT INTO post_fts(post_fts, rowid, body) "
+               "VALUES ('delete', old.id, old.body); END")
+    op.execute("CREATE TRIGGER post_fts_update AFTER UPDATE OF body ON post "
+               "BEGIN "
+               "INSERT INTO post_fts(post_fts, rowid, body) "
+               "VALUES ('delete', old.id, old.body); "
+               "INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body); "
+               "END")
+    # Index the posts that already exist
+    op.execute("INSERT INTO post_fts(post_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TRIGGER post_fts_update')
+    op.execute('DROP TRIGGER post_fts_delete')
+    op.execute('DROP TRIGGER post_fts_insert')
+    op.execute('DROP TABLE post_fts')
@@ -1,8 +1,26 @@
 #!/usr/bin/env python
 from datetime import datetime, timezone, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import re
+import os
+import socket
+import tempfile
+from threading import Thread
+from time import perf_counter, sleep
 import unittest
+from aiosmtpd.controller import Controller
+import sqlalchemy as sa
+from flask import g
 from app import create_app, db
-from app.models import User, Post
+from app.models import User, Post, search_rank, load_user, suggestion
+from app.pagination import keyset_paginate
+from app.translate import translate
+from app.email import send_email
+from app.language import save_languages
+from app.log import JSONFormatter, ThrottledSMTPHandler
+from app.ratelimit import SQLiteStorage, token_bucket, sliding_window
 from config import Config
 
 # Subclass of the application's Config class (overrides the SQLAlchemy config to use an in-memory SQLite database)
@@ -11,6 +29,8 @@ class TestConfig(Config):
     TESTING = True
     # By setting the DATABSE_URL to sqlite:// it prevents unit tests from using the regular database
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    # Lets the test client submit forms without a CSRF token
+    WTF_CSRF_ENABLED = False
 
 
 class UserModelCase(unittest.TestCase):
@@ -105,6 +125,1596 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        post = Post(body='post from john', author=u1)
+        db.session.add(post)
+        post.publish()
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual(u1.posts_count(), 1)
+        self.assertEqual(u1.followers_count(), 1)
+        self.assertEqual(u2.following_count(), 1)
+
+        # counters that drifted are recomputed by the repair command
+        db.session.execute(sa.update(User).values(
+            num_followers=5, num_following=5, num_posts=5))
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(
+            args=['counters', 'repair'])
+        self.assertIn('Repaired the counters of 2 users', result.output)
+        db.session.expire_all()
+        self.assertEqual((u1.num_followers, u1.num_following, u1.num_posts),
+                         (1, 0, 1))
+        self.assertEqual((u2.num_followers, u2.num_following, u2.num_posts),
+                         (0, 1, 0))
+
+    def test_timeline_posts(self):
+        self.app.config['TIMELINE_ENABLED'] = True
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        u4 = User(username='david', email='david@example.com')
+        db.session.add_all([u1, u2, u3, u4])
+        db.session.commit()
+
+        # john follows susan and david, mary follows david, so david is over the fan-out limit
+        u1.follow(u2)
+        u1.follow(u4)
+        u3.follow(u4)
+        db.session.commit()
+
+        now = datetime.now(timezone.utc)
+        posts = []
+        for i, author in enumerate([u1, u2, u3, u4]):
+            post = Post(body='post from ' + author.username, author=author,
+                        timestamp=now + timedelta(seconds=i))
+            db.session.add(post)
+            post.fan_out()
+            posts.append(post)
+        db.session.commit()
+        p1, p2, p3, p4 = posts
+
+        # pushed posts and pulled celebrity posts both show up, same as the join query
+        for u in [u1, u2, u3, u4]:
+            self.assertEqual(db.session.scalars(u.timeline_posts()).all(),
+                             db.session.scalars(u.following_posts()).all())
+        self.assertEqual(db.session.scalars(u1.home_posts()).all(),
+                         [p4, p2, p1])
+
+        # unfollowing removes the inbox entries, following backfills them
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.home_posts()).all(), [p4, p1])
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.home_posts()).all(),
+                         [p4, p2, p1])
+
+        # david drops back under the limit, so his posts get pushed to mary
+        u1.unfollow(u4)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u3.home_posts()).all(), [p4, p3])
+        self.assertEqual(db.session.scalars(u1.home_posts()).all(), [p2, p1])
+
+
+class LastSeenCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['LAST_SEEN_BATCH_SIZE'] = 2
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.tracker = self.app.extensions['last_seen']
+        old = datetime.now(timezone.utc) - timedelta(hours=1)
+        self.users = [User(username=name, email=name + '@example.com',
+                           last_seen=old) for name in ['john', 'susan']]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def tearDown(self):
+        self.tracker.flush()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def stored_last_seen(self, user):
+        return db.session.scalar(
+            sa.select(User.__table__.c.last_seen).where(User.id == user.id))
+
+    def test_batched_writes(self):
+        u1, u2 = self.users
+        old = self.stored_last_seen(u1)
+        self.tracker.touch(u1)
+        # buffered, but visible on the loaded user
+        self.assertEqual(self.stored_last_seen(u1), old)
+        self.assertGreater(u1.last_seen, datetime.now(timezone.utc) -
+                           timedelta(minutes=1))
+        self.assertFalse(db.session.dirty)
+        self.tracker.touch(u2)
+        # the second user fills the batch
+        self.assertGreater(self.stored_last_seen(u1), old)
+        self.assertGreater(self.stored_last_seen(u2), old)
+
+    def test_recent_visit_skipped(self):
+        u1 = self.users[0]
+        self.tracker.touch(u1)
+        self.tracker.flush()
+        stored = self.stored_last_seen(u1)
+        self.tracker.touch(u1)
+        self.assertEqual(self.tracker.pending, {})
+        self.tracker.flush()
+        self.assertEqual(self.stored_last_seen(u1), stored)
+
+
+class PasswordHashingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.hasher = self.app.extensions['password_hasher']
+        self.user = User(username='john', email='john@example.com')
+        self.user.set_password('cat')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def stored_hash(self):
+        return db.session.scalar(sa.select(User.__table__.c.password_hash)
+                                 .where(User.id == self.user.id))
+
+    def test_pool_per_app(self):
+        pool = self.hasher.pool
+        self.assertIsNotNone(pool)
+        # another application stops the threads of this one and starts its own on first use
+        self.hasher.init_app(self.app)
+        self.assertIsNone(self.hasher.pool)
+        with self.assertRaises(RuntimeError):
+            pool.submit(print)
+        self.assertTrue(self.user.check_password('cat'))
+        self.assertIsNotNone(self.hasher.pool)
+
+    def test_rehash_on_login(self):
+        old_hash = self.user.password_hash
+        self.assertTrue(old_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertFalse(self.hasher.needs_rehash(old_hash))
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        self.assertTrue(self.hasher.needs_rehash(old_hash))
+        client = self.app.test_client()
+        response = client.post('/auth/login', data={'username': 'john',
+                                                    'password': 'cat'})
+        self.assertEqual(response.status_code, 302)
+        self.hasher.join()
+        new_hash = self.stored_hash()
+        self.assertTrue(new_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertEqual(self.hasher.stats()['rehashed'], 1)
+        db.session.expire_all()
+        self.assertTrue(self.user.check_password('cat'))
+        # a hash that changed in the meantime is left alone
+        self.assertFalse(self.hasher.store_rehash(self.user.id, old_hash,
+                                                  'dog'))
+        self.assertEqual(self.stored_hash(), new_hash)
+
+    def test_saturated_pool(self):
+        self.app.config['PASSWORD_HASH_TIMEOUT'] = 0.01
+        while self.hasher.slots.acquire(blocking=False):
+            pass
+        client = self.app.test_client()
+        response = client.post('/auth/login', data={'username': 'john',
+                                                    'password': 'cat'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(self.hasher.stats()['rejected'], 1)
+
+
+class UserCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.cache = self.app.extensions['user_cache']
+        user = User(username='john', email='john@example.com',
+                    about_me='hello')
+        user.set_password('cat')
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+        db.session.remove()
+        self.statements = []
+        sa.event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        sa.event.remove(db.engine, 'before_cursor_execute', self.count)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def count(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_cached_load(self):
+        user = load_user(str(self.user_id))
+        self.assertEqual(len(self.statements), 1)
+        db.session.remove()
+        user = load_user(str(self.user_id))
+        # identity only, no queries
+        self.assertEqual((user.id, user.username, user.about_me),
+                         (self.user_id, 'john', 'hello'))
+        self.assertIsNotNone(user.last_seen)
+        self.assertEqual(len(self.statements), 1)
+        self.assertFalse(db.session.dirty)
+        # columns that aren't cached are loaded on use
+        self.assertTrue(user.check_password('cat'))
+        self.assertEqual(user.posts_count(), 0)
+        self.assertEqual(len(self.statements), 2)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_expiry(self):
+        self.app.config['USER_CACHE_TTL'] = 0
+        load_user(str(self.user_id))
+        db.session.remove()
+        load_user(str(self.user_id))
+        self.assertEqual(len(self.statements), 2)
+
+    def test_invalidation(self):
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        load_user(str(self.user_id))
+        client.post('/edit_profile', data={'username': 'johnny',
+                                           'about_me': 'bye'})
+        self.assertIsNone(self.cache.get(self.user_id))
+        db.session.remove()
+        user = load_user(str(self.user_id))
+        self.assertEqual((user.username, user.about_me), ('johnny', 'bye'))
+        client.get('/auth/logout')
+        self.assertIsNone(self.cache.get(self.user_id))
+
+
+class SQLiteProfileCase(unittest.TestCase):
+    def test_production_profile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            class ProductionConfig(TestConfig):
+                SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+                    tmp, 'app.db')
+                SQLITE_PRODUCTION = True
+                DATABASE_POOL_SIZE = 3
+            app = create_app(ProductionConfig)
+            with app.app_context():
+                self.assertEqual(db.engine.pool.size(), 3)
+                with db.engine.connect() as connection:
+                    pragma = connection.exec_driver_sql
+                    self.assertEqual(pragma('PRAGMA journal_mode').scalar(),
+                                     'wal')
+                    self.assertEqual(pragma('PRAGMA synchronous').scalar(), 1)
+                    self.assertEqual(pragma('PRAGMA busy_timeout').scalar(),
+                                     5000)
+                db.engine.dispose()
+
+    def test_memory_database(self):
+        class MemoryConfig(TestConfig):
+            SQLITE_PRODUCTION = True
+        app = create_app(MemoryConfig)
+        with app.app_context():
+            self.assertIsInstance(db.engine.pool, sa.pool.StaticPool)
+
+
+class ReplicaCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+                self.tmp.name, 'primary.db')
+            DATABASE_REPLICA_URLS = ['sqlite:///' + os.path.join(
+                self.tmp.name, 'replica.db')]
+        self.app = create_app(ReplicaConfig)
+        with self.app.app_context():
+            db.create_all()
+            db.metadata.create_all(db.engines['replica0'])
+            # the same user on both databases, replication is up to date
+            for engine in db.engines.values():
+                with engine.begin() as connection:
+                    connection.execute(sa.insert(User), {
+                        'id': 1, 'username': 'john',
+                        'email': 'john@example.com',
+                        'password_hash': self.app.extensions[
+                            'password_hasher'].hash('cat')})
+
+    def tearDown(self):
+        with self.app.app_context():
+            self.app.extensions['language_detector'].join()
+            db.engine.dispose()
+            db.engines['replica0'].dispose()
+        self.tmp.cleanup()
+
+    # Requests run without an outer application context, so each one gets its own 'g'
+    def test_routing(self):
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        with self.app.app_context():
+            db.session.add(Post(body='not replicated yet', user_id=1))
+            db.session.commit()
+        self.assertNotIn('not replicated yet', client.get('/explore').text)
+        client.post('/index', data={'post': 'my own post'})
+        with self.app.app_context():
+            self.assertEqual(db.session.scalar(
+                sa.select(sa.func.count()).select_from(Post)), 2)
+            with db.engines['replica0'].connect() as connection:
+                self.assertEqual(connection.scalar(
+                    sa.select(sa.func.count()).select_from(Post)), 0)
+        # read your writes right after posting
+        page = client.get('/explore').text
+        self.assertIn('my own post', page)
+        self.assertIn('not replicated yet', page)
+        with client.session_transaction() as session:
+            session['primary_until'] = 0
+        self.assertNotIn('my own post', client.get('/explore').text)
+
+
+class ConditionalGetCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        with self.app.app_context():
+            db.create_all()
+            # everything happened an hour ago, so a change now gets a later Last-Modified
+            earlier = datetime.now(timezone.utc) - timedelta(hours=1)
+            john = User(username='john', email='john@example.com',
+                        updated=earlier)
+            john.set_password('cat')
+            susan = User(username='susan', email='susan@example.com',
+                         updated=earlier)
+            susan.set_password('dog')
+            db.session.add_all([john, susan])
+            db.session.add(Post(body='first post', author=susan,
+                                timestamp=earlier))
+            db.session.commit()
+        self.statements = []
+        # Requests run without an outer application context, so each one gets its own 'g'
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'john',
+                                              'password': 'cat'})
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def count(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def revalidate(self, url, response, **headers):
+        with self.app.app_context():
+            sa.event.listen(db.engine, 'before_cursor_execute', self.count)
+        try:
+            return self.client.get(url, headers=dict(
+                {'If-None-Match': response.headers['ETag']}, **headers))
+        finally:
+            with self.app.app_context():
+                sa.event.remove(db.engine, 'before_cursor_execute',
+                                self.count)
+
+    def test_explore(self):
+        response = self.client.get('/explore')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['ETag'].startswith('W/'))
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+        again = self.revalidate('/explore', response)
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.headers['ETag'], response.headers['ETag'])
+        # no post or author queries before the 304
+        self.assertFalse([statement for statement in self.statements
+                          if 'post.body' in statement])
+        since = self.client.get('/explore', headers={
+            'If-Modified-Since': response.headers['Last-Modified']})
+        self.assertEqual(since.status_code, 304)
+        # another locale renders another page
+        self.assertEqual(self.revalidate(
+            '/explore', response, **{'Accept-Language': 'es'}).status_code,
+            200)
+        with self.app.app_context():
+            db.session.add(Post(body='second post', user_id=2))
+            db.session.commit()
+        changed = self.revalidate('/explore', response)
+        self.assertEqual(changed.status_code, 200)
+        self.assertIn('second post', changed.text)
+
+    def test_index_and_user(self):
+        index = self.client.get('/index')
+        profile = self.client.get('/user/susan')
+        self.assertEqual(self.revalidate('/index', index).status_code, 304)
+        self.assertEqual(self.revalidate('/user/susan', profile).status_code,
+                         304)
+        # following changes the home feed and the profile's follow button
+        self.client.post('/follow/susan')
+        self.client.get('/index')  # shows the flashed message
+        self.assertEqual(self.revalidate('/index', index).status_code, 200)
+        self.assertEqual(self.revalidate('/user/susan', profile).status_code,
+                         200)
+
+    # both a matching ETag and an unchanged Last-Modified lead to a 304, so a change has to fail both
+    def assertChanged(self, url, response):
+        changed = self.revalidate(url, response)
+        self.assertEqual(changed.status_code, 200)
+        since = self.client.get(url, headers={
+            'If-Modified-Since': response.headers['Last-Modified']})
+        self.assertEqual(since.status_code, 200)
+        return changed
+
+    def test_detected_language(self):
+        response = self.client.get('/explore')
+        self.assertNotIn('id="translation1"', response.text)
+        with self.app.app_context(), db.engine.begin() as connection:
+            save_languages(connection, [(1, 'es')])
+        self.assertIn('id="translation1"',
+                      self.assertChanged('/explore', response).text)
+
+    def test_author_renamed(self):
+        response = self.client.get('/explore')
+        self.assertEqual(self.revalidate('/explore', response).status_code,
+                         304)
+        susan = self.app.test_client()
+        susan.post('/auth/login', data={'username': 'susan',
+                                        'password': 'dog'})
+        susan.post('/edit_profile', data={'username': 'susan2',
+                                          'about_me': ''},
+                   follow_redirects=True)
+        changed = self.assertChanged('/explore', response)
+        self.assertIn('/user/susan2', changed.text)
+        self.assertNotIn('/user/susan"', changed.text)
+
+    def test_follow(self):
+        index = self.client.get('/index')
+        self.assertNotIn('first post', index.text)
+        self.assertEqual(self.client.get('/index', headers={
+            'If-Modified-Since': index.headers['Last-Modified']}).status_code,
+            304)
+        self.client.post('/follow/susan')
+        self.client.get('/index')  # shows the flashed message
+        changed = self.assertChanged('/index', index)
+        self.assertIn('first post', changed.text)
+
+    def test_flashed_messages(self):
+        response = self.client.get('/explore')
+        with self.client.session_transaction() as session:
+            session['_flashes'] = [('message', 'hello')]
+        self.assertEqual(self.revalidate('/explore', response).status_code,
+                         200)
+
+
+class ApiCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        john = User(username='john', email='john@example.com')
+        john.set_password('cat')
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([john, susan])
+        now = datetime.now(timezone.utc)
+        db.session.add_all([
+            Post(body='post {}'.format(i), author=[john, susan][i % 2],
+                 timestamp=now + timedelta(seconds=i), language='en')
+            for i in range(5)])
+        db.session.commit()
+        john.follow(susan)
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def token(self):
+        response = self.client.post('/api/v1/tokens', auth=('john', 'cat'))
+        self.assertEqual(response.status_code, 200)
+        return {'Authorization': 'Bearer ' + response.json['token']}
+
+    def test_tokens(self):
+        self.assertEqual(self.client.post(
+            '/api/v1/tokens', auth=('john', 'dog')).status_code, 401)
+        response = self.client.get('/api/v1/timeline/explore')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.headers['WWW-Authenticate'], 'Bearer')
+        headers = self.token()
+        response = self.client.get('/api/v1/timeline/explore', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Set-Cookie', response.headers)
+        self.assertEqual(self.client.delete(
+            '/api/v1/tokens', headers=headers).status_code, 204)
+        self.assertEqual(self.client.get(
+            '/api/v1/timeline/explore', headers=headers).status_code, 401)
+
+    def test_timelines(self):
+        headers = self.token()
+        response = self.client.get('/api/v1/timeline/explore?limit=2',
+                                   headers=headers)
+        data = response.json
+        self.assertEqual([post['body'] for post in data['posts']],
+                         ['post 4', 'post 3'])
+        self.assertEqual(set(data['posts'][0]),
+                         {'id', 'body', 'timestamp', 'language', 'author'})
+        # each author once
+        self.assertEqual(sorted(author['username']
+                                for author in data['authors'].values()),
+                         ['john', 'susan'])
+        self.assertIsNone(data['prev'])
+        bodies = [post['body'] for post in data['posts']]
+        url = data['next']
+        while url:
+            data = self.client.get(url, headers=headers).json
+            bodies += [post['body'] for post in data['posts']]
+            url = data['next']
+        self.assertEqual(bodies, ['post {}'.format(i) for i in range(4, -1, -1)])
+
+        data = self.client.get('/api/v1/users/susan/posts?fields=id,body',
+                               headers=headers).json
+        self.assertEqual(data['posts'], [{'id': 4, 'body': 'post 3'},
+                                         {'id': 2, 'body': 'post 1'}])
+        self.assertNotIn('authors', data)
+        data = self.client.get('/api/v1/timeline/home?fields=body',
+                               headers=headers).json
+        self.assertEqual(len(data['posts']), 5)
+        response = self.client.get('/api/v1/timeline/home?fields=body,secret',
+                                   headers=headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('message', response.json)
+        response = self.client.get('/api/v1/users/nobody/posts',
+                                   headers=headers)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json['error'], 'Not Found')
+
+    def test_error_headers(self):
+        hasher = self.app.extensions['password_hasher']
+        self.app.config['PASSWORD_HASH_TIMEOUT'] = 0.01
+        while hasher.slots.acquire(blocking=False):
+            pass
+        response = self.client.post('/api/v1/tokens', auth=('john', 'cat'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json['error'], 'Service Unavailable')
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+
+class StreamCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['STREAM_ENABLED'] = True
+        self.app.config['STREAM_HEARTBEAT'] = 0.05
+        self.app.config['STREAM_QUEUE_SIZE'] = 2
+        # the in-memory database has a single connection, background language detection would share it with the requests
+        self.app.config['LANGUAGE_DETECTION_WORKERS'] = 0
+        self.stream = self.app.extensions['post_stream']
+        with self.app.app_context():
+            db.create_all()
+            users = [User(username=name, email=name + '@example.com')
+                     for name in ['john', 'susan', 'mary']]
+            for user in users:
+                user.set_password('cat')
+            db.session.add_all(users)
+            db.session.commit()
+            users[0].follow(users[1])
+            db.session.commit()
+
+    def tearDown(self):
+        with self.app.app_context():
+            self.app.extensions['language_detector'].join()
+            db.session.remove()
+            db.drop_all()
+
+    # Requests run without an outer application context, so each one gets its own 'g'
+    def login(self, username):
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': username,
+                                         'password': 'cat'})
+        return client
+
+    def test_followers_are_notified(self):
+        john = self.stream.subscribe(1)
+        mary = self.stream.subscribe(3)
+        susan = self.login('susan')
+        susan.post('/index', data={'post': 'hello'})
+        self.assertEqual(john.queue.get_nowait(),
+                         {'id': 1, 'author': 'susan'})
+        self.assertTrue(mary.queue.empty())
+        # a client that doesn't keep up loses notifications, the queue stays bounded
+        for i in range(3):
+            susan.post('/index', data={'post': 'post {}'.format(i)})
+        self.assertEqual(john.queue.qsize(), 2)
+        self.assertEqual(john.dropped, 1)
+        self.stream.unsubscribe(john)
+        self.stream.unsubscribe(mary)
+        self.assertEqual(self.stream.stats()['connections'], 0)
+        self.assertEqual(self.stream.stats()['dropped'], 1)
+
+    def test_event_stream(self):
+        self.assertEqual(self.app.test_client().get('/stream').status_code,
+                         302)
+        response = self.login('john').get('/stream')
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        events = iter(response.response)
+        self.assertTrue(next(events).startswith(b'retry:'))
+        self.assertEqual(self.stream.stats()['connections'], 1)
+        self.assertEqual(next(events), b': heartbeat\n\n')
+        self.login('susan').post('/index', data={'post': 'hello'})
+        self.assertEqual(next(events), b'id: 1\nevent: post\ndata: '
+                         b'{"id": 1, "author": "susan"}\n\n')
+        # the client went away
+        response.close()
+        self.assertEqual(self.stream.stats()['connections'], 0)
+        self.assertIn(b'new EventSource', self.login('john').get('/index').data)
+
+    def test_connection_limit(self):
+        self.app.config['STREAM_MAX_CONNECTIONS'] = 1
+        john = self.login('john')
+        response = john.get('/stream')
+        self.assertEqual(response.status_code, 200)
+        full = self.login('susan').get('/stream')
+        self.assertEqual(full.status_code, 503)
+        self.assertEqual(full.headers['Retry-After'], '300')
+        self.assertEqual(self.stream.stats()['rejected'], 1)
+        response.close()
+        # a HEAD request never starts the events, the connection is still given back
+        head = john.head('/stream')
+        self.assertEqual(head.status_code, 200)
+        head.close()
+        self.assertEqual(self.stream.stats()['connections'], 0)
+
+    def test_disabled(self):
+        self.app.config['STREAM_ENABLED'] = False
+        john = self.login('john')
+        self.assertEqual(john.get('/stream').status_code, 204)
+        self.assertEqual(self.stream.stats()['connections'], 0)
+        self.assertNotIn(b'EventSource', john.get('/index').data)
+
+    def test_database_broker(self):
+        self.app.config['STREAM_BROKER'] = 'database'
+        self.app.config['STREAM_POLL_INTERVAL'] = 0.01
+        john = self.stream.subscribe(1)
+        sleep(0.1)
+        # written by another process
+        with self.app.app_context():
+            db.session.add(Post(body='hello', user_id=2))
+            db.session.commit()
+        self.assertEqual(john.queue.get(timeout=1),
+                         {'id': 1, 'author': 'susan'})
+        # the poller stops with the last connection
+        poller = self.stream.poller
+        self.stream.unsubscribe(john)
+        poller.join(timeout=1)
+        self.assertFalse(poller.is_alive())
+        self.assertIsNone(self.stream.poller)
+
+
+class SuggestionCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = {name: User(username=name, email=name + '@example.com')
+                      for name in ['john', 'susan', 'mary', 'david', 'alex']}
+        db.session.add_all(self.users.values())
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def follow(self, *pairs, unfollow=False):
+        for follower, followed in pairs:
+            user = self.users[follower]
+            (user.unfollow if unfollow else user.follow)(self.users[followed])
+        db.session.commit()
+
+    def stored(self):
+        return {(row.user_id, row.suggested_id): row.score
+                for row in db.session.execute(sa.select(suggestion))}
+
+    def rebuild(self):
+        result = self.app.test_cli_runner().invoke(
+            args=['suggestions', 'rebuild', '--batch-size', '2'])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+    def test_friends_of_friends(self):
+        self.follow(('john', 'susan'), ('john', 'mary'), ('susan', 'david'),
+                    ('mary', 'david'), ('mary', 'alex'), ('mary', 'john'))
+        john = self.users['john']
+        self.assertEqual([(user.username, score) for user, score in
+                          db.session.execute(john.suggestions())],
+                         [('david', 2), ('alex', 1)])
+        incremental = self.stored()
+        self.rebuild()
+        self.assertEqual(self.stored(), incremental)
+
+        # following a suggestion removes it, unfollowing brings it back
+        self.follow(('john', 'david'))
+        self.assertEqual([user.username for user, score in
+                          db.session.execute(john.suggestions())], ['alex'])
+        self.follow(('john', 'david'), ('mary', 'alex'), unfollow=True)
+        self.follow(('david', 'alex'))
+        incremental = self.stored()
+        self.assertEqual(incremental[(1, 4)], 2)
+        self.assertNotIn((1, 5), incremental)
+        self.assertEqual(incremental[(3, 5)], 1)
+        self.rebuild()
+        self.assertEqual(self.stored(), incremental)
+
+    def test_per_user_limit(self):
+        self.app.config['SUGGESTIONS_PER_USER'] = 1
+        self.follow(('john', 'susan'), ('john', 'mary'), ('susan', 'david'),
+                    ('mary', 'david'), ('susan', 'alex'))
+        self.assertEqual(self.stored(), {(1, 4): 2})
+        self.follow(('susan', 'david'), unfollow=True)
+        self.assertEqual(self.stored(), {(1, 4): 1})
+        # alex comes back with the score of both accounts following it, not just the new one
+        self.follow(('mary', 'alex'))
+        incremental = self.stored()
+        self.assertEqual(incremental, {(1, 5): 2})
+        self.rebuild()
+        self.assertEqual(self.stored(), incremental)
+
+    def test_fanout_limit(self):
+        self.app.config['SUGGESTIONS_FANOUT_LIMIT'] = 1
+        self.follow(('susan', 'david'), ('susan', 'alex'), ('john', 'susan'))
+        # susan follows too many accounts to vouch for them
+        self.assertEqual(self.stored(), {})
+        self.rebuild()
+        self.assertEqual(self.stored(), {})
+
+    def test_panel(self):
+        self.users['john'].set_password('cat')
+        self.follow(('john', 'susan'), ('susan', 'david'))
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john',
+                                         'password': 'cat'})
+        response = client.get('/index')
+        self.assertIn('Who to follow', response.text)
+        self.assertIn('followed by 1 account you follow', response.text)
+        # a new suggestion changes the page
+        self.follow(('susan', 'alex'))
+        again = client.get('/index', headers={
+            'If-None-Match': response.headers['ETag']})
+        self.assertEqual(again.status_code, 200)
+        self.assertIn('/user/alex', again.text)
+
+
+class RateLimitCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['LANGUAGE_DETECTION_WORKERS'] = 0
+        with self.app.app_context():
+            db.create_all()
+            for name in ['john', 'susan']:
+                user = User(username=name, email=name + '@example.com')
+                user.set_password('cat')
+                db.session.add(user)
+            db.session.commit()
+
+    def tearDown(self):
+        with self.app.app_context():
+            self.app.extensions['language_detector'].join()
+            db.session.remove()
+            db.drop_all()
+
+    def login(self, username):
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': username,
+                                         'password': 'cat'})
+        return client
+
+    def test_token_bucket(self):
+        state, retry_after = token_bucket(None, 100, 2, 60)
+        self.assertEqual(retry_after, 0)
+        state, retry_after = token_bucket(state, 100, 2, 60)
+        self.assertEqual(retry_after, 0)
+        state, retry_after = token_bucket(state, 100, 2, 60)
+        self.assertEqual(retry_after, 30)
+        # one token back after half the period
+        state, retry_after = token_bucket(state, 130, 2, 60)
+        self.assertEqual(retry_after, 0)
+
+    def test_sliding_window(self):
+        state = None
+        for now in [60, 70]:
+            state, retry_after = sliding_window(state, now, 2, 60)
+            self.assertEqual(retry_after, 0)
+        state, retry_after = sliding_window(state, 110, 2, 60)
+        self.assertEqual(retry_after, 10)
+        # the previous window still counts for 3/4 of its requests, then for half of them
+        state, retry_after = sliding_window(state, 135, 2, 60)
+        self.assertEqual(retry_after, 15)
+        state, retry_after = sliding_window(state, 150, 2, 60)
+        self.assertEqual(retry_after, 0)
+        state, retry_after = sliding_window(state, 155, 2, 60)
+        self.assertEqual(retry_after, 25)
+
+    def test_login(self):
+        self.app.config['RATELIMIT_LOGIN'] = '2/minute'
+        client = self.app.test_client()
+        for i in range(2):
+            response = client.post('/auth/login', data={'username': 'john',
+                                                        'password': 'dog'})
+            self.assertEqual(response.headers['Location'], '/auth/login')
+        response = client.post('/auth/login', data={'username': 'john',
+                                                    'password': 'cat'})
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response.headers['Retry-After']), 0)
+        # the form can still be shown
+        self.assertEqual(client.get('/auth/login').status_code, 200)
+        self.app.config['RATELIMIT_ENABLED'] = False
+        self.assertEqual(client.post('/auth/login', data={
+            'username': 'john', 'password': 'cat'}).status_code, 302)
+
+    def test_api_token(self):
+        self.app.config['RATELIMIT_LOGIN'] = '2/minute'
+        client = self.app.test_client()
+        for i in range(2):
+            self.assertEqual(client.post('/api/v1/tokens', auth=(
+                'john', 'dog')).status_code, 401)
+        response = client.post('/api/v1/tokens', auth=('john', 'cat'))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json['error'], 'Too Many Requests')
+        self.assertGreater(int(response.headers['Retry-After']), 0)
+
+    def test_reverse_proxy(self):
+        class ProxyConfig(TestConfig):
+            REVERSE_PROXIES = 1
+            RATELIMIT_LOGIN = '1/minute'
+        app = create_app(ProxyConfig)
+        with app.app_context():
+            db.create_all()
+        client = app.test_client()
+
+        def login(address):
+            return client.post('/auth/login', data={
+                'username': 'john', 'password': 'dog'},
+                headers={'X-Forwarded-For': address}).status_code
+        self.assertEqual(login('192.0.2.1'), 302)
+        self.assertEqual(login('192.0.2.1'), 429)
+        # another client behind the same proxy has a limit of its own
+        self.assertEqual(login('192.0.2.2'), 302)
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_posts_per_user(self):
+        self.app.config['RATELIMIT_POST'] = '1/minute'
+        john = self.login('john')
+        self.assertEqual(john.post('/index', data={
+            'post': 'first'}).status_code, 302)
+        response = john.post('/index', data={'post': 'second'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '60')
+        self.assertEqual(john.get('/index').status_code, 200)
+        self.assertEqual(self.login('susan').post('/index', data={
+            'post': 'hello'}).status_code, 302)
+        self.assertEqual(self.app.extensions['rate_limiter'].stats()[
+            'limited'], 1)
+
+    def test_sqlite_storage(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'ratelimit.db')
+            # two processes sharing the file
+            first, second = SQLiteStorage(path, 1), SQLiteStorage(path, 1)
+            self.assertEqual(first.hit('key', token_bucket, 100, 2, 60), 0)
+            self.assertEqual(second.hit('key', token_bucket, 100, 2, 60), 0)
+            self.assertEqual(first.hit('key', token_bucket, 100, 2, 60), 30)
+            self.assertEqual(second.hit('other', token_bucket, 100, 2, 60), 0)
+            # expired entries start over
+            self.assertEqual(second.hit('key', token_bucket, 300, 2, 60), 0)
+            first.local.connection.close()
+            second.local.connection.close()
+
+
+class LanguageCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        self.user.set_password('cat')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_background_detection(self):
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        client.post('/index', data={
+            'post': 'El rápido zorro marrón salta sobre el perro perezoso'})
+        post = db.session.scalar(sa.select(Post))
+        self.assertEqual(post.author, self.user)
+        self.app.extensions['language_detector'].join()
+        db.session.refresh(post)
+        self.assertEqual(post.language, 'es')
+
+    def test_submit_during_warm_up(self):
+        detector = self.app.extensions['language_detector']
+        post = Post(body='The quick brown fox jumps over the lazy dog',
+                    author=self.user)
+        db.session.add(post)
+        db.session.commit()
+        # the workers are stuck loading the language profiles, posts are still queued right away
+        with detector.warm_up_lock:
+            started = perf_counter()
+            detector.submit(post)
+            self.assertLess(perf_counter() - started, 1)
+        detector.join()
+        db.session.refresh(post)
+        self.assertEqual(post.language, 'en')
+
+    def test_backfill(self):
+        db.session.add_all([
+            Post(body='The quick brown fox jumps over the lazy dog',
+                 author=self.user),
+            Post(body='Le renard brun rapide saute par-dessus le chien',
+                 author=self.user, language='en')])
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(
+            args=['language', 'backfill', '--chunk-size', '1'])
+        self.assertIn('Detected the language of 1 posts', result.output)
+        self.assertEqual(db.session.scalars(
+            sa.select(Post.language).order_by(Post.id)).all(), ['en', 'en'])
+        self.app.test_cli_runner().invoke(args=['language', 'backfill', '--all'])
+        db.session.expire_all()
+        self.assertEqual(db.session.scalars(
+            sa.select(Post.language).order_by(Post.id)).all(), ['en', 'fr'])
+
+
+class BulkDataCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def path(self, name, content=None):
+        path = os.path.join(self.tmp.name, name)
+        if content is not None:
+            with open(path, 'w') as f:
+                f.write(content)
+        return path
+
+    def test_import_export(self):
+        runner = self.app.test_cli_runner()
+        users = self.path('users.jsonl', (
+            '{"username": "john", "email": "john@example.com", '
+            '"password": "cat"}\n'
+            '{"username": "susan", "email": "susan@example.com"}\n'))
+        result = runner.invoke(args=['data', 'import', 'user', users,
+                                     '--chunk-size', '1', '--workers', '1'])
+        self.assertIn('Imported 2 rows into user', result.output)
+        john = db.session.scalar(sa.select(User).where(User.username == 'john'))
+        self.assertTrue(john.check_password('cat'))
+        self.assertIsNone(db.session.scalar(sa.select(User.password_hash).where(
+            User.username == 'susan')))
+
+        posts = self.path('posts.csv', (
+            'body,user_id,timestamp\n'
+            'hello my dear friends,1,2024-01-01T10:00:00\n'
+            '"Hola, a todos mis amigos",1,\n'))
+        result = runner.invoke(args=['data', 'import', 'post', posts,
+                                     '--workers', '1', '--defer-language'])
+        self.assertIn('Imported 2 rows into post', result.output)
+        rows = db.session.execute(sa.select(
+            Post.body, Post.timestamp, Post.language).order_by(Post.id)).all()
+        self.assertEqual(rows[0].timestamp, datetime(2024, 1, 1, 10))
+        self.assertEqual(rows[1].body, 'Hola, a todos mis amigos')
+        self.assertIsNotNone(rows[1].timestamp)
+        self.assertEqual([row.language for row in rows], [None, None])
+
+        for name in ['posts.jsonl', 'posts.csv']:
+            result = runner.invoke(args=['data', 'export', 'post',
+                                         self.path('export-' + name)])
+            self.assertIn('Exported 2 rows from post', result.output)
+        with open(self.path('export-posts.jsonl')) as f:
+            exported = [json.loads(line) for line in f]
+        self.assertEqual([post['body'] for post in exported],
+                         [row.body for row in rows])
+        self.assertEqual(exported[0]['timestamp'], '2024-01-01T10:00:00')
+
+        # credentials stay out of user exports unless asked for
+        john.get_token(3600)
+        db.session.commit()
+        runner.invoke(args=['data', 'export', 'user',
+                            self.path('export-users.jsonl')])
+        with open(self.path('export-users.jsonl')) as f:
+            exported = json.loads(f.readline())
+        self.assertEqual(exported['username'], 'john')
+        self.assertFalse({'password_hash', 'token', 'token_expiration'} &
+                         set(exported))
+        runner.invoke(args=['data', 'export', 'user', '--include-secrets',
+                            self.path('export-users.csv')])
+        with open(self.path('export-users.csv')) as f:
+            header = f.readline().strip().split(',')
+        self.assertIn('password_hash', header)
+        self.assertNotIn('token', header)
+
+    def test_post_download(self):
+        john = User(username='john', email='john@example.com')
+        john.set_password('cat')
+        db.session.add(john)
+        db.session.add_all([Post(body='post {}'.format(i), author=john)
+                            for i in range(5)])
+        db.session.commit()
+        self.app.config['EXPORT_CHUNK_SIZE'] = 2
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        response = client.get('/user/john/posts.jsonl')
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.headers['Accept-Ranges'], 'id')
+        posts = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual([post['body'] for post in posts],
+                         ['post {}'.format(i) for i in range(5)])
+        # Resuming after the second post, from the query string or a Range header
+        response = client.get('/user/john/posts.jsonl?since_id=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([json.loads(line)['id']
+                          for line in response.text.splitlines()], [3, 4, 5])
+        response = client.get('/user/john/posts.csv',
+                              headers={'Range': 'id=4-'})
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['Content-Range'], 'id 4-5/*')
+        lines = response.text.splitlines()
+        self.assertEqual(lines[0], 'id,body,timestamp,language')
+        self.assertEqual([line.split(',')[1] for line in lines[1:]],
+                         ['post 4'])
+        self.assertEqual(client.get('/user/susan/posts.csv').status_code, 404)
+
+
+# Local stand-in SMTP server, counts connections and keeps the delivered messages
+class SMTPHandler:
+    def __init__(self):
+        self.connections = 0
+        self.messages = []
+
+    async def handle_EHLO(self, server, session, envelope, hostname,
+                          responses):
+        self.connections += 1
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        return '250 OK'
+
+
+class EmailCase(unittest.TestCase):
+    def setUp(self):
+        self.handler = SMTPHandler()
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        self.smtp = Controller(self.handler, hostname='127.0.0.1', port=port)
+        self.smtp.start()
+
+        class MailConfig(TestConfig):
+            MAIL_SERVER = '127.0.0.1'
+            MAIL_PORT = port
+            MAIL_SUPPRESS_SEND = False
+            MAIL_WORKERS = 1
+            MAIL_RETRY_DELAY = 0
+
+        self.app = create_app(MailConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.mail_queue = self.app.extensions['mail_queue']
+
+    def tearDown(self):
+        self.mail_queue.stop()
+        self.app_context.pop()
+        self.smtp.stop()
+
+    def test_connection_reused(self):
+        for i in range(5):
+            self.assertTrue(send_email('message {}'.format(i),
+                                       'admin@example.com',
+                                       ['user@example.com'], 'text', 'html'))
+        self.mail_queue.join()
+        self.assertEqual(len(self.handler.messages), 5)
+        self.assertEqual(self.handler.connections, 1)
+        stats = self.mail_queue.stats()
+        self.assertEqual((stats['sent'], stats['depth']), (5, 0))
+
+    def test_backpressure(self):
+        self.app.config['MAIL_QUEUE_TIMEOUT'] = 0.01
+        self.mail_queue.queue.maxsize = 1
+        # no workers are running, so the second message finds the queue full
+        self.mail_queue.workers = [None]
+        self.assertTrue(send_email('first', 'admin@example.com',
+                                   ['user@example.com'], 'text', 'html'))
+        self.assertFalse(send_email('second', 'admin@example.com',
+                                    ['user@example.com'], 'text', 'html'))
+        self.assertEqual(self.mail_queue.stats()['rejected'], 1)
+        self.mail_queue.workers = []
+
+    def test_stop_sends_queued_mail(self):
+        for i in range(3):
+            send_email('message {}'.format(i), 'admin@example.com',
+                       ['user@example.com'], 'text', 'html')
+        workers = list(self.mail_queue.workers)
+        self.mail_queue.stop()
+        self.assertEqual(len(self.handler.messages), 3)
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+        self.assertEqual(self.mail_queue.stats()['workers'], 0)
+
+
+# Log handler that keeps the formatted records, slowly
+class SlowListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        sleep(0.05)
+        self.lines.append(self.format(record))
+
+
+class LogPipelineCase(unittest.TestCase):
+    def setUp(self):
+        self.handler = SMTPHandler()
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.smtp = Controller(self.handler, hostname='127.0.0.1',
+                               port=self.port)
+        self.smtp.start()
+        self.app = create_app(TestConfig)
+        self.pipeline = self.app.extensions['log_pipeline']
+        self.logger = logging.getLogger('microblog-test')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+
+    def tearDown(self):
+        self.pipeline.stop()
+        self.smtp.stop()
+
+    def test_queued_json_lines(self):
+        output = SlowListHandler()
+        output.setFormatter(JSONFormatter())
+        self.pipeline.start(self.logger, [output])
+        start = perf_counter()
+        with self.app.test_request_context('/explore'):
+            for i in range(5):
+                self.logger.info('message %d', i, extra={'fields': {'n': i}})
+            try:
+                1 / 0
+            except ZeroDivisionError:
+                self.logger.exception('failed')
+        # the slow handler runs on the listener thread
+        self.assertLess(perf_counter() - start, 0.05)
+        self.pipeline.stop()
+        lines = [json.loads(line) for line in output.lines]
+        self.assertEqual([line['message'] for line in lines],
+                         ['message {}'.format(i) for i in range(5)] +
+                         ['failed'])
+        self.assertEqual((lines[0]['path'], lines[0]['n']), ('/explore', 0))
+        self.assertIn('ZeroDivisionError', lines[-1]['exception'])
+        self.assertEqual(lines[-1]['level'], 'ERROR')
+
+    def test_throttled_emails(self):
+        mail_handler = ThrottledSMTPHandler(
+            ('127.0.0.1', self.port), 'no-reply@example.com',
+            ['admin@example.com'], 'Microblog Failure', interval=60, limit=2)
+        self.pipeline.start(self.logger, [mail_handler])
+        for message in ['error A', 'error A', 'error B', 'error C']:
+            self.logger.error(message)
+        self.pipeline.stop()
+        self.assertEqual(len(self.handler.messages), 2)
+        self.assertIn(b'Subject: Microblog Failure (1 similar errors '
+                      b'suppressed)', self.handler.messages[1].content)
+        self.assertEqual(mail_handler.suppressed, 1)
+        # a new interval starts, the next email counts what was left out
+        mail_handler.window -= 60
+        self.pipeline.start(self.logger, [mail_handler])
+        self.logger.error('error D')
+        self.pipeline.stop()
+        self.assertEqual(len(self.handler.messages), 3)
+        self.assertIn(b'Subject: Microblog Failure (1 similar errors '
+                      b'suppressed)', self.handler.messages[-1].content)
+
+
+# Local stand-in for the translator service, answers every text with an upper cased copy
+class TranslatorHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        TranslatorHandler.requests.append((self.path, body))
+        data = json.dumps([{'translations': [{'text': item['Text'].upper()}]}
+                           for item in body]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TranslateCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), TranslatorHandler)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['MS_TRANSLATOR_KEY'] = 'test'
+        self.app.config['MS_TRANSLATOR_URL'] = 'http://127.0.0.1:{}'.format(
+            self.server.server_port)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.cache = self.app.extensions['translation_cache']
+        TranslatorHandler.requests = []
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_cache_hit(self):
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.assertEqual(translate('hola', 'es', 'fr'), 'HOLA')
+        self.assertEqual(len(TranslatorHandler.requests), 2)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_lru_and_ttl(self):
+        self.app.config['TRANSLATION_CACHE_SIZE'] = 2
+        for text in ['uno', 'dos', 'uno', 'tres']:
+            translate(text, 'es', 'en')
+        # 'dos' was the least recently used entry
+        self.assertIsNone(self.cache.get(self.cache.key('dos', 'es', 'en')))
+        self.assertEqual(self.cache.get(self.cache.key('uno', 'es', 'en')),
+                         'UNO')
+        self.app.config['TRANSLATION_CACHE_TTL'] = 0
+        translate('cuatro', 'es', 'en')
+        self.assertIsNone(
+            self.cache.get(self.cache.key('cuatro', 'es', 'en')))
+
+    def test_persistent_store(self):
+        self.app.config['TRANSLATION_CACHE_PERSIST'] = True
+        translate('hola', 'es', 'en')
+        # a restarted worker finds the result in the translation table
+        self.cache.clear()
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.assertEqual(len(TranslatorHandler.requests), 1)
+        self.assertEqual(self.cache.stats()['store_hits'], 1)
+
+    def test_batch_route(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        response = client.post('/translate', json={
+            'dest_language': 'en',
+            'items': [{'text': 'hola', 'source_language': 'es'},
+                      {'text': 'bonjour', 'source_language': 'fr'},
+                      {'text': 'adios', 'source_language': 'es'}]})
+        self.assertEqual(response.json['texts'], ['HOLA', 'BONJOUR', 'ADIOS'])
+        # one service call per source language, texts packed in the array body
+        self.assertEqual(sorted((body for path, body in
+                                 TranslatorHandler.requests), key=len),
+                         [[{'Text': 'bonjour'}],
+                          [{'Text': 'hola'}, {'Text': 'adios'}]])
+        response = client.post('/translate', json={
+            'text': 'hola', 'source_language': 'es', 'dest_language': 'en'})
+        self.assertEqual(response.json['text'], 'HOLA')
+        self.assertEqual(len(TranslatorHandler.requests), 2)
+
+
+class PaginationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        # two posts share a timestamp, the id breaks the tie
+        self.posts = [Post(body='post {}'.format(i), author=u,
+                           timestamp=now + timedelta(seconds=min(i, 5)))
+                      for i in range(7)]
+        db.session.add_all(self.posts)
+        db.session.commit()
+        self.query = sa.select(Post)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def paginate(self, **args):
+        with self.app.test_request_context('/explore', query_string=args):
+            return keyset_paginate(self.query, (Post.timestamp, Post.id), 3)
+
+    def test_cursor_pages(self):
+        newest_first = sorted(self.posts, key=lambda p: (p.timestamp, p.id),
+                              reverse=True)
+        page1 = self.paginate()
+        self.assertEqual(page1.items, newest_first[:3])
+        self.assertFalse(page1.has_prev)
+        page2 = self.paginate(**page1.next_args)
+        self.assertEqual(page2.items, newest_first[3:6])
+        page3 = self.paginate(**page2.next_args)
+        self.assertEqual(page3.items, newest_first[6:])
+        self.assertFalse(page3.has_next)
+
+        # walking back with the 'before' cursors
+        back = self.paginate(**page3.prev_args)
+        self.assertEqual(back.items, newest_first[3:6])
+        back = self.paginate(**back.prev_args)
+        self.assertEqual(back.items, newest_first[:3])
+        self.assertFalse(back.has_prev)
+
+    def test_page_compatibility(self):
+        page2 = self.paginate(page=2)
+        self.assertEqual([p.body for p in page2.items],
+                         ['post 3', 'post 2', 'post 1'])
+        self.assertEqual(page2.prev_args, {'page': 1})
+        self.assertEqual(self.paginate(**page2.next_args).items[0].body,
+                         'post 0')
+        # garbage cursors fall back to the first page
+        self.assertEqual(self.paginate(after='garbage').items,
+                         self.paginate().items)
+
+    def test_no_count_query(self):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        sa.event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            self.paginate(page=2)
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('count(', statements[0].lower())
+
+
+class SearchCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['POSTS_PER_PAGE'] = 2
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        self.user.set_password('cat')
+        self.posts = [Post(body=body, author=self.user) for body in [
+            'hello world', 'hello there, hello again', 'goodbye world',
+            'hello']]
+        db.session.add_all(self.posts)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def search(self, text):
+        return db.session.scalars(
+            Post.search(text).order_by(search_rank, Post.id)).all()
+
+    def test_ranked_results(self):
+        p1, p2, p3, p4 = self.posts
+        self.assertEqual(self.search('hello'), [p4, p2, p1])
+        self.assertEqual(self.search('WORLD'), [p1, p3])
+        # query syntax is matched literally
+        self.assertEqual(self.search('hello" OR "world'), [])
+        self.assertEqual(self.search('"'), [])
+
+    def test_index_follows_changes(self):
+        p1, p2, p3, p4 = self.posts
+        p3.body = 'hello goodbye'
+        db.session.delete(p4)
+        db.session.commit()
+        self.assertEqual(self.search('goodbye'), [p3])
+        self.assertEqual(set(self.search('hello')), {p1, p2, p3})
+        result = self.app.test_cli_runner().invoke(args=['search', 'rebuild'])
+        self.assertIn('Search index rebuilt', result.output)
+        self.assertEqual(self.search('goodbye'), [p3])
+
+    def test_search_view(self):
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        response = client.get('/search?q=hello')
+        html = response.get_data(as_text=True)
+        self.assertIn('hello there', html)
+        self.assertNotIn('hello world', html)
+        next_url = re.search(r'href="(/search\?[^"]*after=[^"]*)"',
+                             html).group(1).replace('&amp;', '&')
+        html = client.get(next_url).get_data(as_text=True)
+        self.assertIn('hello world', html)
+        self.assertNotIn('hello there', html)
+
+
+class FragmentCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        self.user.set_password('cat')
+        db.session.add(Post(body='hola mundo', author=self.user, language='es'))
+        db.session.commit()
+        self.cache = self.app.extensions['fragment_cache']
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'john',
+                                              'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_cached_fragments(self):
+        first = self.client.get('/explore').get_data(as_text=True)
+        second = self.client.get('/explore').get_data(as_text=True)
+        self.assertEqual(first, second)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        # the locale is part of the key
+        post = db.session.scalar(sa.select(Post))
+        with self.app.test_request_context():
+            g.locale = 'es'
+            self.assertNotIn('Translate', self.cache.render_post(post))
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_username_change(self):
+        self.client.get('/explore')
+        self.client.post('/edit_profile', data={'username': 'johnny',
+                                                'about_me': ''})
+        self.assertEqual(self.cache.stats()['size'], 0)
+        html = self.client.get('/explore').get_data(as_text=True)
+        self.assertIn('/user/johnny', html)
+
+    def test_lru_eviction(self):
+        self.app.config['FRAGMENT_CACHE_SIZE'] = 1
+        db.session.add(Post(body='hello world', author=self.user))
+        db.session.commit()
+        self.client.get('/explore')
+        self.assertEqual(self.cache.stats()['size'], 1)
+
+
+class InstrumentationCase(unittest.TestCase):
+    def setUp(self):
+        class InstrumentedConfig(TestConfig):
+            INSTRUMENTATION_ENABLED = True
+            INSTRUMENTATION_SLOW_QUERY = 0
+
+        self.app = create_app(InstrumentedConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        for name, email in [('john', 'john@example.com'),
+                            ('admin', self.app.config['ADMINS'][0])]:
+            u = User(username=name, email=email)
+            u.set_password('cat')
+            db.session.add(u)
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_server_timing(self):
+        self.client.post('/auth/login', data={'username': 'john',
+                                              'password': 'cat'})
+        response = self.client.get('/explore')
+        timing = response.headers['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[0-9.]+;desc="\d+ queries"')
+        self.assertIn('tpl;dur=', timing)
+        self.assertIn('total;dur=', timing)
+        # only admins can see the aggregated metrics
+        self.assertEqual(self.client.get('/admin/metrics').status_code, 403)
+
+    def test_metrics(self):
+        self.client.post('/auth/login', data={'username': 'admin',
+                                              'password': 'cat'})
+        self.client.get('/explore')
+        self.client.get('/explore')
+        data = self.client.get('/admin/metrics').json
+        explore = data['endpoints']['main.explore']
+        self.assertEqual(explore['requests'], 2)
+        self.assertGreater(explore['queries_per_request'], 0)
+        self.assertEqual(sum(explore['histogram_ms'].values()), 2)
+        self.assertTrue(data['slow_queries'])
+        self.assertIn('statement', data['slow_queries'][0])
+        self.assertIn('hits', data['fragment_cache'])
+
+
+class FeedQueryCase(unittest.TestCase):
+    # Upper bound on SQL statements for rendering a full page of posts, it must not grow with the number of authors on the page
+    MAX_STATEMENTS = 8
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        users = [User(username='user{}'.format(i),
+                      email='user{}@example.com'.format(i))
+                 for i in range(30)]
+        users[0].set_password('cat')
+        db.session.add_all(users)
+        db.session.commit()
+        for u in users[1:]:
+            users[0].follow(u)
+        db.session.add_all([Post(body='post from ' + u.username, author=u)
+                            for u in users])
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'user0',
+                                              'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def count_statements(self, url):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        sa.event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = self.client.get(url)
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(response.status_code, 200)
+        return len(statements)
+
+    def test_index(self):
+        self.assertLessEqual(self.count_statements('/index'),
+                             self.MAX_STATEMENTS)
+
+    def test_explore(self):
+        self.assertLessEqual(self.count_statements('/explore'),
+                             self.MAX_STATEMENTS)
+
+    def test_user(self):
+        self.assertLessEqual(self.count_statements('/user/user1'),
+                             self.MAX_STATEMENTS)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file